@@ -1,23 +1,103 @@
+import time
+MODULE_STARTED = time.perf_counter()    # 啟動耗時報告的起點（含載入 discord.py 等套件）
 import os
+import abc
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import csv
+import difflib
+import functools
+import heapq
+import io
+import itertools
 import random
+import secrets
+import socket
 import discord
 from discord.ext import commands
 from discord import app_commands
 from discord.ui import View, Button, Modal, TextInput
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, jsonify
-import threading
-import requests
+from collections import OrderedDict, deque
+import aiohttp
+import hashlib
 import json
+import logging
+import sqlite3
+import sys
+import tempfile
+import threading
+import traceback
 
 # --- 環境設定 ---
 load_dotenv()
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 GUILD_ID = int(os.getenv("DISCORD_GUILD_ID", "0"))
+GUILD_IDS = [int(g) for g in os.getenv("DISCORD_GUILD_IDS", "").replace(",", " ").split()] or [GUILD_ID]
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None                 # None = 由 Discord 建議
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").replace(",", " ").split()] or None
+PROCESS_ID = os.getenv("PROCESS_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+def process_local_path(filename: str):
+    """多行程部署時每個行程各用一份本地檔案（依 PROCESS_ID 或 SHARD_IDS 命名），單一行程維持原檔名"""
+    tag = os.getenv("PROCESS_ID") or ("shard" + "-".join(map(str, SHARD_IDS)) if SHARD_IDS else "")
+    if not tag:
+        return filename
+    tag = "".join(c if c.isalnum() or c in "-_" else "_" for c in tag)
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{tag}{ext}"
+
 PEIPLAY_API_URL = os.getenv("PEIPLAY_API_URL", "http://localhost:3004")
+PEIPLAY_SYNC_PATH = os.getenv("PEIPLAY_SYNC_PATH", "")   # Outbox 批次同步端點；PeiPlay 後端尚未提供，留空 = 只保存在本地
 ADMIN_CHANNEL_ID = int(os.getenv("ADMIN_CHANNEL_ID", "0"))
+PEIPLAY_API_TIMEOUT = float(os.getenv("PEIPLAY_API_TIMEOUT", "5"))
+PEIPLAY_API_RETRIES = int(os.getenv("PEIPLAY_API_RETRIES", "2"))
+PEIPLAY_API_POOL_SIZE = int(os.getenv("PEIPLAY_API_POOL_SIZE", "20"))
+BOT_DB_PATH = os.getenv("BOT_DB_PATH", process_local_path("peiplay_bot.db"))
+OUTBOX_MAX_SIZE = int(os.getenv("OUTBOX_MAX_SIZE", "10000"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_FLUSH_INTERVAL = float(os.getenv("OUTBOX_FLUSH_INTERVAL", "2"))
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "2048"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "0"))  # 0 = 每場配對立即推送
+CONTROL_API_HOST = os.getenv("CONTROL_API_HOST", "0.0.0.0")
+CONTROL_API_PORT = int(os.getenv("CONTROL_API_PORT", "5000"))                # 0 = 不啟動 Control API
+CONTROL_API_MAX_CONCURRENCY = int(os.getenv("CONTROL_API_MAX_CONCURRENCY", "64"))
+CONTROL_API_TOKEN = os.getenv("CONTROL_API_TOKEN", "")  # 設定後所有請求都要帶 Authorization: Bearer <token>；匯出端點一律需要
+DISCORD_GLOBAL_RATE = float(os.getenv("DISCORD_GLOBAL_RATE", "50"))      # 每秒請求數
+DISCORD_MOVE_RATE = float(os.getenv("DISCORD_MOVE_RATE", "5"))           # 每個伺服器每秒移動數
+DISCORD_MOVE_BURST = int(os.getenv("DISCORD_MOVE_BURST", "10"))
+DISCORD_MOVE_CONCURRENCY = int(os.getenv("DISCORD_MOVE_CONCURRENCY", "8"))
+MOVE_BATCH_MAX = int(os.getenv("MOVE_BATCH_MAX", "500"))
+CHANNEL_POOL_SIZE = int(os.getenv("CHANNEL_POOL_SIZE", "0"))             # 0 = 不預建頻道
+CHANNEL_POOL_LOOKAHEAD = int(os.getenv("CHANNEL_POOL_LOOKAHEAD", "900"))  # 依未來 N 秒內的排程預先補充
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", process_local_path("peiplay_journal.jsonl"))
+JOURNAL_SNAPSHOT_EVERY = int(os.getenv("JOURNAL_SNAPSHOT_EVERY", "1000"))
+JOURNAL_STALE_SECONDS = float(os.getenv("JOURNAL_STALE_SECONDS", "900"))     # 停機期間錯過開始時間超過此秒數的排程直接取消
+LOOP_WATCHDOG_INTERVAL = float(os.getenv("LOOP_WATCHDOG_INTERVAL", "0.25"))  # 0 = 不啟動迴圈監控
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+TRACE_KEEP = int(os.getenv("TRACE_KEEP", "500"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")                     # memory = 單一行程 / sqlite = 同主機多行程
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "peiplay_state.db")
+STATE_OWNER_TTL = float(os.getenv("STATE_OWNER_TTL", "30"))
+MAILBOX_POLL_INTERVAL = float(os.getenv("MAILBOX_POLL_INTERVAL", "0.2"))
+MAILBOX_TIMEOUT = float(os.getenv("MAILBOX_TIMEOUT", "10"))
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+EMPTY_SESSION_GRACE_SECONDS = float(os.getenv("EMPTY_SESSION_GRACE_SECONDS", "120"))  # 所有人離開後多久提前結束
+NO_SHOW_GRACE_SECONDS = float(os.getenv("NO_SHOW_GRACE_SECONDS", "0"))                # 開場後都沒有人進來就提前結束；0 = 不啟用
+MESSAGE_COALESCE_WINDOW = float(os.getenv("MESSAGE_COALESCE_WINDOW", "0.25"))  # 同頻道訊息合併的等待時間
+MESSAGE_RATE = float(os.getenv("MESSAGE_RATE", "1"))                           # 每個頻道每秒訊息數
+MESSAGE_BURST = int(os.getenv("MESSAGE_BURST", "5"))
+MESSAGE_SEND_CONCURRENCY = int(os.getenv("MESSAGE_SEND_CONCURRENCY", "16"))
+MATCH_QUEUE_TIMEOUT = float(os.getenv("MATCH_QUEUE_TIMEOUT", "600"))    # 排隊多久沒配到就移出（需短於互動 token 的 15 分鐘）
+MATCH_WAIT_WEIGHT = float(os.getenv("MATCH_WAIT_WEIGHT", "0.5"))       # 每多等一分鐘相當於多幾顆星
+MATCH_START_DELAY = float(os.getenv("MATCH_START_DELAY", "30"))        # 配對成功到開場的緩衝
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "1000"))        # 匯出時每次從 SQLite 讀取的列數
 
 # --- Discord Bot 設定 ---
 intents = discord.Intents.default()
@@ -26,74 +106,614 @@ intents.guilds = True
 intents.members = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
-active_voice_channels = {}
-evaluated_records = set()
-pending_ratings = {}
+class PeiPlayBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        startup.mark("登入")
+        # 只啟動目前設定需要的子系統
+        if loop_watchdog.interval > 0:
+            loop_watchdog.start()
+        self._instrument_http()
+        journal.load()
+        startup.mark("載入排程日誌")
+        if peiplay_api.sync_path:
+            outbox.start(peiplay_api)
+        admin_reporter.start()
+        if control_api.enabled:
+            await control_api.start()
+            startup.mark("啟動 Control API")
+
+    def _instrument_http(self):
+        """為每個 Discord REST 請求記錄延遲（以 route 樣板分組）"""
+        request = self.http.request
+
+        async def timed_request(route, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await request(route, **kwargs)
+            finally:
+                discord_rest_latency.observe(time.perf_counter() - started, f"{route.method} {route.path}")
+
+        self.http.request = timed_request
+
+    async def close(self):
+        loop_watchdog.stop()
+        for pool in channel_pools.values():
+            pool.stop()
+        await command_mailbox.stop()
+        await control_api.stop()
+        await admin_reporter.stop()
+        await message_queue.close()
+        await outbox.stop()
+        await peiplay_api.close()
+        journal.close()
+        await super().close()
+
+bot = PeiPlayBot(command_prefix="!", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+# Slash 指令註冊到每個合作伺服器；同步時每個行程只同步自己連線到的伺服器
+COMMAND_GUILDS = [discord.Object(id=g) for g in GUILD_IDS]
+
+WARNING_SECONDS = 60
+EXTEND_SECONDS = 600
+RATING_WINDOW_SECONDS = 300
 
 ANIMALS = ["🦊 狐狸", "🐱 貓咪", "🐶 小狗", "🐻 熊熊", "🐼 貓熊", "🐯 老虎", "🦁 獅子", "🐸 青蛙", "🐵 猴子"]
 TW_TZ = timezone(timedelta(hours=8))
+SESSION_CATEGORY_NAME = "語音頻道"
+SESSION_TEXT_CHANNEL_NAME = "🔒匿名文字區"
+
+# --- 指標 ---
+class Counter:
+    __slots__ = ("name", "help", "label_names", "values")
+
+    def __init__(self, name: str, help: str, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def inc(self, *labels, value: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{format_labels(self.label_names, labels)} {value}"
+
+class Histogram:
+    """固定 bucket 的直方圖；observe 只有一次 bisect 與幾個加法"""
+
+    __slots__ = ("name", "help", "label_names", "buckets", "series")
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}    # labels -> [各 bucket 次數..., 超出最後一個 bucket 的次數, sum, count]
+
+    def observe(self, value: float, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_bucket{format_labels(self.label_names + ('le',), labels + ('+Inf',))} {series[-1]}"
+            yield f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]}"
+            yield f"{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}"
+
+class Gauge:
+    """抓取時才計算數值的 gauge"""
+
+    __slots__ = ("name", "help", "fn")
+
+    def __init__(self, name: str, help: str, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.fn()}"
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v).replace(chr(34), chr(39))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+class MetricsRegistry:
+    """Prometheus 文字格式的指標集合"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, label_names=()):
+        metric = Counter(name, help, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label_names=(), buckets=Histogram.DEFAULT_BUCKETS):
+        metric = Histogram(name, help, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, fn):
+        metric = Gauge(name, help, fn)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                print(f"⚠️ 指標 {metric.name} 輸出失敗: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+discord_rest_latency = metrics.histogram("peiplay_discord_rest_latency_seconds", "Discord REST 請求延遲", ["route"])
+discord_rate_limited = metrics.counter("peiplay_discord_rate_limited_total", "Discord 回應 429 的次數", ["scope"])
+peiplay_api_latency = metrics.histogram("peiplay_api_latency_seconds", "PeiPlay API 請求延遲", ["method", "path"])
+peiplay_api_errors = metrics.counter("peiplay_api_errors_total", "PeiPlay API 錯誤次數", ["path", "reason"])
+session_start_lag = metrics.histogram("peiplay_session_start_lag_seconds", "場次實際開始與排程時間的差距", [],
+                                      buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+countdown_drift = metrics.histogram("peiplay_countdown_drift_seconds", "截止時間實際觸發的延遲", ["kind"],
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+interaction_latency = metrics.histogram("peiplay_interaction_seconds", "Slash 指令從送出到完成的時間", ["command"])
+gateway_reconnect = metrics.histogram("peiplay_gateway_reconnect_seconds", "Gateway 斷線到恢復的時間", ["kind"],
+                                      buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+class RateLimitLogHandler(logging.Handler):
+    """從 discord.py 的 rate limit 警告計算 429 次數"""
+
+    def emit(self, record):
+        if record.msg.startswith("We are being rate limited"):
+            discord_rate_limited.inc("any")
+        elif record.msg.startswith("Global rate limit has been hit"):
+            discord_rate_limited.inc("global")
+
+logging.getLogger("discord.http").addHandler(RateLimitLogHandler(logging.WARNING))
+
+# --- 迴圈監控與追蹤 ---
+loop_lag = metrics.histogram("peiplay_loop_lag_seconds", "事件迴圈排程延遲", [],
+                             buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+loop_stalls = metrics.counter("peiplay_loop_stalls_total", "事件迴圈被佔用超過門檻的次數")
+
+class LoopWatchdog:
+    """事件迴圈卡頓偵測
+
+    迴圈內的心跳量測每次 sleep 的延遲；另一個執行緒在心跳停住超過門檻時，
+    直接擷取迴圈執行緒當下的 stack，找出佔住迴圈的 callback。
+    """
+
+    def __init__(self, interval: float = LOOP_WATCHDOG_INTERVAL, threshold: float = LOOP_STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = deque(maxlen=20)   # (時間, 已卡住秒數, stack)
+        self._beat = time.monotonic()
+        self._loop_thread_id = None
+        self._reported = False
+        self._task = None
+        self._stopped = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            loop_lag.observe(max(0.0, now - expected))
+            self._beat = now
+            self._reported = False
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            stalled = time.monotonic() - self._beat - self.interval
+            if stalled < self.threshold or self._reported:
+                continue
+            self._reported = True
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.stalls.append((datetime.now(TW_TZ), stalled, stack))
+            loop_stalls.inc()
+            print(f"⚠️ 事件迴圈已被佔用 {stalled:.2f} 秒以上，目前執行位置：\n{stack}")
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+loop_watchdog = LoopWatchdog()
+
+class Span:
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def format(self, depth: int = 0, origin: float = None):
+        origin = self.start if origin is None else origin
+        lines = [f"{'  ' * depth}{self.name}  +{(self.start - origin) * 1000:.0f}ms  {self.duration * 1000:.1f}ms"]
+        for child in self.children:
+            lines.extend(child.format(depth + 1, origin))
+        return lines
+
+class Tracer:
+    """Slash 指令與場次流程的 span 樹（TRACE_ENABLED=1 時才記錄）"""
+
+    def __init__(self, enabled: bool = TRACE_ENABLED, keep: int = TRACE_KEEP):
+        self.enabled = enabled
+        self.recent = deque(maxlen=keep)
+        self._current = contextvars.ContextVar("peiplay_span", default=None)
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        if not self.enabled:
+            yield None
+            return
+        parent = self._current.get()
+        span = Span(name)
+        if parent is not None:
+            parent.children.append(span)
+        token = self._current.set(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            self._current.reset(token)
+            if parent is None:
+                self.recent.append(span)
+
+    def slowest(self, n: int = 5):
+        return sorted(self.recent, key=lambda span: span.duration, reverse=True)[:n]
+
+tracer = Tracer()
+
+def traced(name: str):
+    """以 span 包住整個指令處理函式"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # --- 成員搜尋函數 ---
+class MemberIndex:
+    """以 casefold 名稱建立的伺服器成員索引（使用者名稱 / 全域名稱 / 顯示名稱）
+
+    on_ready 時建立一次，之後由成員加入、離開、更新事件增量維護，
+    查詢為 O(1)。找不到時先以名稱的 bigram 篩出少量候選，再做模糊比對提供建議，
+    不會掃過整個伺服器的名稱。
+    """
+
+    FIELDS = ("name", "global_name", "display_name")
+    BUILD_BATCH = 250           # 建立索引時每處理這麼多位成員就讓出事件迴圈
+    SUGGEST_CANDIDATES = 200    # 模糊比對的候選上限
+
+    def __init__(self):
+        self._guilds = {}   # guild_id -> {field: {key: set(member_id)}}
+        self._grams = {}    # guild_id -> {bigram: set(key)}
+        self._keys = {}     # (guild_id, member_id) -> {field: key}
+        self._building = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _key(value):
+        return value.casefold() if value else None
+
+    @staticmethod
+    def _bigrams(key):
+        return {key[i:i + 2] for i in range(len(key) - 1)} or {key}
+
+    async def build(self, guild):
+        """重建索引；建立期間查詢退回逐一比對，並定期讓出事件迴圈"""
+        self._building.add(guild.id)
+        try:
+            self._guilds[guild.id] = {field: {} for field in self.FIELDS}
+            self._grams[guild.id] = {}
+            for key in [k for k in self._keys if k[0] == guild.id]:
+                del self._keys[key]
+            for i, member in enumerate(list(guild.members), 1):
+                # 建立期間也會收到成員事件，用 update 保持冪等
+                self.update(member)
+                if i % self.BUILD_BATCH == 0:
+                    await asyncio.sleep(0)
+        finally:
+            self._building.discard(guild.id)
+        print(f"✅ 成員索引已建立：{guild.name}（{len(guild.members)} 位成員）")
+
+    def add(self, member):
+        index = self._guilds.get(member.guild.id)
+        if index is None:
+            return
+        grams = self._grams[member.guild.id]
+        keys = {}
+        for field in self.FIELDS:
+            key = self._key(getattr(member, field, None))
+            if key:
+                index[field].setdefault(key, set()).add(member.id)
+                keys[field] = key
+                for gram in self._bigrams(key):
+                    grams.setdefault(gram, set()).add(key)
+        self._keys[(member.guild.id, member.id)] = keys
+
+    def remove(self, member):
+        index = self._guilds.get(member.guild.id)
+        keys = self._keys.pop((member.guild.id, member.id), None)
+        if index is None or keys is None:
+            return
+        grams = self._grams[member.guild.id]
+        for field, key in keys.items():
+            ids = index[field].get(key)
+            if ids:
+                ids.discard(member.id)
+                if not ids:
+                    del index[field][key]
+            if not any(key in index[f] for f in self.FIELDS):
+                for gram in self._bigrams(key):
+                    bucket = grams.get(gram)
+                    if bucket:
+                        bucket.discard(key)
+                        if not bucket:
+                            del grams[gram]
+
+    def update(self, member):
+        self.remove(member)
+        self.add(member)
+
+    def lookup(self, guild, name):
+        """依序比對使用者名稱、全域名稱、顯示名稱
+
+        全域名稱與顯示名稱可能重複；同一個名稱對到多位成員時不猜測，回傳 None，
+        由呼叫端改為提供建議（使用者名稱是唯一的）。
+        """
+        index = self._guilds.get(guild.id)
+        key = self._key(name)
+        if index is None or guild.id in self._building:
+            # 索引尚未建立完成（on_ready 之前），退回逐一比對
+            return discord.utils.find(lambda m: m.name.casefold() == key, guild.members)
+        for field in self.FIELDS:
+            members = [m for m in (guild.get_member(i) for i in index[field].get(key, ())) if m]
+            if len(members) == 1:
+                return members[0]
+            if members:
+                return None
+        return None
+
+    def _candidates(self, guild_id, key):
+        """與 key 共用最多 bigram 的名稱（最多 SUGGEST_CANDIDATES 個）"""
+        grams = self._grams.get(guild_id, {})
+        counts = {}
+        for gram in self._bigrams(key):
+            for candidate in grams.get(gram, ()):
+                counts[candidate] = counts.get(candidate, 0) + 1
+        return heapq.nlargest(self.SUGGEST_CANDIDATES, counts, key=counts.__getitem__)
+
+    def suggest(self, guild, name, limit=3):
+        """找不到成員時提供相近的使用者名稱"""
+        index = self._guilds.get(guild.id)
+        if index is None:
+            return []
+        key = self._key(name)
+        if not key:
+            return []
+        # 名稱重複時完全相符的成員也要列出，讓使用者改用使用者名稱指定
+        matches = difflib.get_close_matches(key, self._candidates(guild.id, key), n=limit, cutoff=0.6)
+        if key not in matches and any(key in index[field] for field in self.FIELDS):
+            matches.insert(0, key)
+        suggestions = []
+        for match in matches:
+            for field in self.FIELDS:
+                for member_id in index[field].get(match, ()):
+                    member = guild.get_member(member_id)
+                    if member and member.name not in suggestions:
+                        suggestions.append(member.name)
+        return suggestions[:limit]
+
+member_index = MemberIndex()
+
 def find_member_by_name(guild, name):
     """不區分大小寫搜尋成員"""
-    name_lower = name.lower()
-    print(f"搜尋名稱: {name} (轉小寫: {name_lower})")
-    
-    for member in guild.members:
-        print(f"檢查成員: {member.name} (小寫: {member.name.lower()})")
-        if member.name.lower() == name_lower:
-            print(f"找到匹配: {member.name}")
-            return member
-    
-    print(f"未找到匹配的成員: {name}")
-    return None
+    return member_index.lookup(guild, name)
 
 # --- PeiPlay API 整合 ---
+class CircuitOpenError(Exception):
+    """PeiPlay API 斷路器開啟中，暫停送出請求"""
+
+class PeiPlayAPIError(Exception):
+    """PeiPlay API 回應非 2xx（已排除會重試的狀態碼）"""
+
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+    @property
+    def retryable(self):
+        return not (400 <= self.status < 500) or self.status in (408, 429)
+
 class PeiPlayAPI:
-    def __init__(self, base_url: str):
-        self.base_url = base_url
-        self.session = requests.Session()
-    
-    def get_user_by_discord(self, discord_id: str):
+    """非同步 PeiPlay API 用戶端
+
+    整個 bot 生命週期共用一個 aiohttp 連線池（keep-alive），
+    每個請求都有逾時，失敗時以 jitter 退避重試；連續失敗達門檻後斷路器開啟，
+    冷卻期間直接失敗，不再讓請求卡住事件迴圈；冷卻結束後（half-open）只放行一個探測請求，
+    其餘請求在探測完成前同樣直接失敗。
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, timeout: float = PEIPLAY_API_TIMEOUT, retries: int = PEIPLAY_API_RETRIES,
+                 pool_size: int = PEIPLAY_API_POOL_SIZE, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 sync_path: str = PEIPLAY_SYNC_PATH):
+        self.base_url = base_url.rstrip("/")
+        self.sync_path = sync_path
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._session = None
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def circuit_state(self):
+        if self._opened_at is None:
+            return "closed"
+        if asyncio.get_running_loop().time() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+    def _record_success(self):
+        self._failures = 0
+        self._opened_at = None
+
+    def _record_failure(self):
+        self._failures += 1
+        if self._failures >= self.failure_threshold or self._opened_at is not None:
+            self._opened_at = asyncio.get_running_loop().time()
+
+    async def _request(self, method: str, path: str, *, json_body=None, timeout: float = None):
+        """送出請求並回傳 (status, data)；重試用盡或斷路器開啟時拋出例外"""
+        state = self.circuit_state
+        if state == "open" or (state == "half-open" and self._probing):
+            peiplay_api_errors.inc(path, "circuit_open")
+            raise CircuitOpenError("PeiPlay API 暫時無法使用（斷路器開啟）")
+        if state == "half-open":
+            self._probing = True
+            try:
+                return await self._attempt(method, path, json_body, timeout)
+            finally:
+                self._probing = False
+        return await self._attempt(method, path, json_body, timeout)
+
+    async def _attempt(self, method: str, path: str, json_body, timeout: float):
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # full jitter 退避，避免大量請求同時重試
+                await asyncio.sleep(random.uniform(0, min(4.0, 0.25 * 2 ** attempt)))
+            started = time.perf_counter()
+            try:
+                async with self._get_session().request(method, f"{self.base_url}{path}", json=json_body,
+                                                       timeout=client_timeout) as response:
+                    if response.status in self.RETRY_STATUSES:
+                        peiplay_api_errors.inc(path, str(response.status))
+                        last_error = RuntimeError(f"HTTP {response.status}")
+                        continue
+                    data = None
+                    if response.content_type == "application/json":
+                        data = await response.json()
+                    self._record_success()
+                    return response.status, data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                peiplay_api_errors.inc(path, type(e).__name__)
+                last_error = e
+            finally:
+                peiplay_api_latency.observe(time.perf_counter() - started, method, path)
+
+        self._record_failure()
+        raise last_error
+
+    async def ping(self):
+        """檢查 PeiPlay API 連線，回傳 HTTP 狀態碼"""
+        status, _ = await self._request("GET", "/api/user/profile", timeout=5)
+        return status
+
+    async def get_user_by_discord(self, discord_id: str):
         """透過 Discord ID 查詢 PeiPlay 用戶"""
         try:
             # 這裡需要實作查詢邏輯
             # 可能需要透過 email 或其他方式來關聯 Discord ID
-            response = self.session.get(f"{self.base_url}/api/user/profile")
-            if response.status_code == 200:
-                return response.json()
+            status, data = await self._request("GET", "/api/user/profile")
+            if status == 200:
+                return data
             return None
         except Exception as e:
             print(f"查詢 PeiPlay 用戶失敗: {e}")
             return None
-    
-    def create_discord_booking(self, user1_id: str, user2_id: str, duration_minutes: int, animal_name: str):
-        """創建 Discord 配對記錄"""
+
+    def _enqueue(self, kind: str, idempotency_key: str, payload: dict):
+        """排入 outbox 等待同步；未設定同步端點時不寫入（資料已由 pairing_history 保存在本地）"""
+        if self.sync_path:
+            outbox.put(kind, idempotency_key, payload)
+
+    async def send_batch(self, items: list):
+        """批次送出 outbox 中的記錄，PeiPlay 端以 idempotency_key 去重"""
+        status, data = await self._request("POST", self.sync_path, json_body={"items": items})
+        if status >= 300:
+            raise PeiPlayAPIError(status)
+        return data
+
+    async def create_discord_booking(self, record_id: str, user1_id: str, user2_id: str, duration_minutes: int, animal_name: str):
+        """創建 Discord 配對記錄（寫入 outbox，由背景工作批次同步）"""
         try:
             # 創建一個特殊的 booking 類型來記錄 Discord 配對
             booking_data = {
                 "type": "discord_pairing",
+                "record_id": record_id,
                 "user1_discord_id": user1_id,
                 "user2_discord_id": user2_id,
                 "duration_minutes": duration_minutes,
                 "animal_name": animal_name,
                 "created_at": datetime.now().isoformat()
             }
-            
-            # 這裡可以呼叫 PeiPlay API 來創建記錄
-            # 暫時回傳本地記錄
+            self._enqueue("discord_pairing", f"{record_id}:booking", booking_data)
             return {
-                "id": f"discord_{datetime.now().timestamp()}",
+                "id": record_id,
                 "success": True,
                 "data": booking_data
             }
         except Exception as e:
             print(f"創建 Discord booking 失敗: {e}")
             return None
-    
-    def create_discord_review(self, booking_id: str, reviewer_id: str, reviewee_id: str, rating: int, comment: str = None):
-        """創建 Discord 評價"""
+
+    async def create_discord_review(self, booking_id: str, reviewer_id: str, reviewee_id: str, rating: int, comment: str = None):
+        """創建 Discord 評價（寫入 outbox，由背景工作批次同步）"""
         try:
             review_data = {
                 "booking_id": booking_id,
@@ -104,366 +724,2978 @@ class PeiPlayAPI:
                 "type": "discord_review",
                 "created_at": datetime.now().isoformat()
             }
-            
-            # 這裡可以呼叫 PeiPlay API 來創建評價
+            self._enqueue("discord_review", f"{booking_id}:review:{reviewer_id}", review_data)
             return {"success": True, "data": review_data}
         except Exception as e:
             print(f"創建 Discord review 失敗: {e}")
             return None
 
-# --- 本地配對記錄 ---
-class DiscordPairingRecord:
-    def __init__(self, user1_id: str, user2_id: str, duration: int, animal_name: str):
-        self.id = f"discord_{datetime.now().timestamp()}"
-        self.user1_id = user1_id
-        self.user2_id = user2_id
-        self.duration = duration
-        self.animal_name = animal_name
-        self.extended_times = 0
-        self.rating = None
-        self.comment = None
-        self.created_at = datetime.now()
-        self.peiplay_booking_id = None
-
-# --- 評分 Modal ---
-class RatingModal(Modal, title="匿名評分與留言"):
-    rating = TextInput(label="給予評分（1～5 星）", required=True)
-    comment = TextInput(label="留下你的留言（選填）", required=False)
-
-    def __init__(self, record_id):
-        super().__init__()
-        self.record_id = record_id
-
-    async def on_submit(self, interaction: discord.Interaction):
+    async def report_discord_attendance(self, record_id: str, attendance: dict):
+        """回報每位參與者實際在語音頻道內的時段（寫入 outbox，由背景工作批次同步）"""
         try:
-            rating = int(str(self.rating))
-            if rating < 1 or rating > 5:
-                await interaction.response.send_message("❌ 評分必須在 1-5 之間。", ephemeral=True)
-                return
-                
-            comment = str(self.comment) if self.comment else None
-            
-            # 找到對應的記錄
-            record = None
-            for vc_id, data in active_voice_channels.items():
-                if data.get('record_id') == self.record_id:
-                    record = data.get('record')
-                    break
-            
-            if record:
-                record.rating = rating
-                record.comment = comment
-                
-                # 創建 PeiPlay review
-                reviewer_id = str(interaction.user.id)
-                reviewee_id = record.user2_id if reviewer_id == record.user1_id else record.user1_id
-                
-                peiplay_api = PeiPlayAPI(PEIPLAY_API_URL)
-                review_result = peiplay_api.create_discord_review(
-                    booking_id=record.id,
-                    reviewer_id=reviewer_id,
-                    reviewee_id=reviewee_id,
-                    rating=rating,
-                    comment=comment
-                )
-                
-                if review_result and review_result.get('success'):
-                    if self.record_id not in pending_ratings:
-                        pending_ratings[self.record_id] = []
-                    pending_ratings[self.record_id].append({
-                        'rating': rating,
-                        'comment': comment,
-                        'user1': reviewer_id,
-                        'user2': reviewee_id
-                    })
-                    
-                    evaluated_records.add(self.record_id)
-                    await interaction.response.send_message("✅ 感謝你的匿名評價！", ephemeral=True)
-                else:
-                    await interaction.response.send_message("❌ 評價提交失敗，請稍後再試。", ephemeral=True)
-            else:
-                await interaction.response.send_message("❌ 找不到對應的配對記錄。", ephemeral=True)
-                
-        except ValueError:
-            await interaction.response.send_message("❌ 請輸入有效的數字評分。", ephemeral=True)
+            attendance_data = {
+                "type": "discord_attendance",
+                "record_id": record_id,
+                "attendance": {
+                    user_id: [{"joined_at": joined, "left_at": left} for joined, left in spans]
+                    for user_id, spans in attendance.items()
+                },
+                "created_at": datetime.now().isoformat()
+            }
+            self._enqueue("discord_attendance", f"{record_id}:attendance", attendance_data)
+            return {"success": True, "data": attendance_data}
         except Exception as e:
-            await interaction.response.send_message(f"❌ 提交失敗：{e}", ephemeral=True)
+            print(f"回報 Discord 出席時間失敗: {e}")
+            return None
 
-# --- 延長按鈕 ---
-class ExtendView(View):
-    def __init__(self, vc_id):
-        super().__init__(timeout=None)
-        self.vc_id = vc_id
+peiplay_api = PeiPlayAPI(PEIPLAY_API_URL)
 
-    @discord.ui.button(label="🔁 延長 10 分鐘", style=discord.ButtonStyle.primary)
-    async def extend_button(self, interaction: discord.Interaction, button: Button):
-        if self.vc_id not in active_voice_channels:
-            await interaction.response.send_message("❗ 頻道資訊不存在或已刪除。", ephemeral=True)
-            return
-        active_voice_channels[self.vc_id]['remaining'] += 600
-        active_voice_channels[self.vc_id]['extended'] += 1
-        await interaction.response.send_message("⏳ 已延長 10 分鐘。", ephemeral=True)
+# --- 本地資料庫與 Outbox ---
+def open_local_db(path: str):
+    """開啟本地 SQLite（WAL 模式），寫入只需要微秒等級"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
 
-# --- Bot 啟動 ---
-@bot.event
-async def on_ready():
-    print(f"✅ Bot 上線：{bot.user}")
-    print(f"🌐 PeiPlay API URL: {PEIPLAY_API_URL}")
-    try:
-        guild = discord.Object(id=GUILD_ID)
-        synced = await bot.tree.sync(guild=guild)
-        print(f"✅ Slash 指令已同步：{len(synced)} 個指令")
-    except Exception as e:
-        print(f"❌ 指令同步失敗: {e}")
+class OutboxFullError(Exception):
+    """Outbox 已達上限，拒絕新的記錄（backpressure）"""
 
-@bot.event
-async def on_message(message):
-    if message.author == bot.user:
-        return
-    if message.content == "!ping":
-        await message.channel.send("Pong!")
-    await bot.process_commands(message)
+class Outbox:
+    """寫入後再同步（write-behind）的持久化 outbox
 
-# --- 倒數邏輯 ---
-async def countdown(vc_id, animal_channel_name, text_channel, vc, interaction, mentioned, record):
-    try:
-        for user in [interaction.user] + mentioned:
-            if user.voice and user.voice.channel:
-                await user.move_to(vc)
+    記錄先寫進本地 SQLite，背景工作再批次送到 PeiPlay API；
+    程式崩潰重啟後，未確認的記錄會自動重送。
+    """
 
-        view = ExtendView(vc.id)
-        await text_channel.send(f"🎉 語音頻道 {animal_channel_name} 已開啟！\n⏳ 可延長10分鐘 ( 為了您有更好的遊戲體驗，請到最後需要時再點選 ) 。", view=view)
+    def __init__(self, conn, max_size: int = OUTBOX_MAX_SIZE, batch_size: int = OUTBOX_BATCH_SIZE,
+                 flush_interval: float = OUTBOX_FLUSH_INTERVAL):
+        self.conn = conn
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT UNIQUE NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL DEFAULT 0,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt_at ON outbox(next_attempt_at)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_dead_letter (
+                id INTEGER PRIMARY KEY,
+                idempotency_key TEXT UNIQUE NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                status INTEGER NOT NULL,
+                failed_at REAL NOT NULL
+            )
+        """)
+        self.size = self.conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        self.enqueued_total = 0
+        self.rejected_total = 0
+        self.flushed_total = 0
+        self.failed_batches_total = 0
+        self.dead_lettered_total = 0
+        self._wakeup = None
+        self._task = None
+        if self.size:
+            print(f"📦 Outbox 有 {self.size} 筆未同步記錄，將重新送出")
 
-        while active_voice_channels[vc_id]['remaining'] > 0:
-            remaining = active_voice_channels[vc_id]['remaining']
-            if remaining == 60:
-                await text_channel.send("⏰ 剩餘 1 分鐘。")
-            await asyncio.sleep(1)
-            active_voice_channels[vc_id]['remaining'] -= 1
+    def put(self, kind: str, idempotency_key: str, payload: dict):
+        """寫入一筆記錄；同一個 idempotency_key 只會保留一筆"""
+        if self.size >= self.max_size:
+            self.rejected_total += 1
+            raise OutboxFullError(f"Outbox 已滿（{self.size}/{self.max_size}）")
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO outbox (idempotency_key, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+            (idempotency_key, kind, json.dumps(payload, ensure_ascii=False), time.time())
+        )
+        if cursor.rowcount:
+            self.size += 1
+            self.enqueued_total += 1
+            if self._wakeup and self.size >= self.batch_size:
+                self._wakeup.set()
 
-        await vc.delete()
-        await text_channel.send("📝 請點擊以下按鈕進行匿名評分。")
+    def stats(self):
+        row = self.conn.execute("SELECT created_at FROM outbox ORDER BY id LIMIT 1").fetchone()
+        return {
+            "depth": self.size,
+            "max_size": self.max_size,
+            "oldest_age_seconds": round(time.time() - row[0], 1) if row else 0,
+            "enqueued_total": self.enqueued_total,
+            "rejected_total": self.rejected_total,
+            "flushed_total": self.flushed_total,
+            "failed_batches_total": self.failed_batches_total,
+            "dead_letter": self.conn.execute("SELECT COUNT(*) FROM outbox_dead_letter").fetchone()[0],
+            "dead_lettered_total": self.dead_lettered_total,
+        }
 
-        class SubmitButton(View):
-            def __init__(self):
-                super().__init__(timeout=300)
-                self.clicked = False
+    def _take_batch(self):
+        return self.conn.execute(
+            "SELECT id, idempotency_key, kind, payload, attempts FROM outbox "
+            "WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), self.batch_size)
+        ).fetchall()
 
-            @discord.ui.button(label="匿名評分", style=discord.ButtonStyle.success)
-            async def submit(self, interaction: discord.Interaction, button: Button):
-                if self.clicked:
-                    await interaction.response.send_message("❗ 已提交過評價。", ephemeral=True)
-                    return
-                self.clicked = True
-                await interaction.response.send_modal(RatingModal(record.id))
+    def _ack(self, ids):
+        self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+        self.size -= len(ids)
+        self.flushed_total += len(ids)
 
-        await text_channel.send(view=SubmitButton())
-        await asyncio.sleep(300)
-        await text_channel.delete()
+    def _dead_letter(self, rows, status: int):
+        """PeiPlay 明確拒絕（不會重試的 4xx）的記錄移到 dead-letter 表，留待人工處理"""
+        ids = [(row[0],) for row in rows]
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO outbox_dead_letter (id, idempotency_key, kind, payload, attempts, created_at, "
+                "status, failed_at) SELECT id, idempotency_key, kind, payload, attempts + 1, created_at, ?, ? "
+                "FROM outbox WHERE id = ?",
+                [(status, time.time(), row_id) for (row_id,) in ids]
+            )
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", ids)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.size -= len(ids)
+        self.dead_lettered_total += len(ids)
 
-        record.extended_times = active_voice_channels[vc_id]['extended']
-        record.duration += record.extended_times * 600
+    def _retry_later(self, rows):
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+            [(now + min(300, 2 ** attempts) * random.uniform(0.5, 1.0), row_id) for row_id, _, _, _, attempts in rows]
+        )
 
-        admin = bot.get_channel(ADMIN_CHANNEL_ID)
-        if admin:
+    async def flush(self, api):
+        """送出所有已到期的記錄，回傳成功筆數"""
+        sent = 0
+        while True:
+            rows = self._take_batch()
+            if not rows:
+                return sent
+            items = [
+                {"idempotency_key": key, "type": kind, "data": json.loads(payload)}
+                for _, key, kind, payload, _ in rows
+            ]
             try:
-                u1 = await bot.fetch_user(int(record.user1_id))
-                u2 = await bot.fetch_user(int(record.user2_id))
-                header = f"📋 配對紀錄：{u1.mention} × {u2.mention} | {record.duration//60} 分鐘 | 延長 {record.extended_times} 次"
-
-                if record.id in pending_ratings:
-                    feedback = "\n⭐ 評價回饋："
-                    for r in pending_ratings[record.id]:
-                        from_user = await bot.fetch_user(int(r['user1']))
-                        to_user = await bot.fetch_user(int(r['user2']))
-                        feedback += f"\n- 「{from_user.mention} → {to_user.mention}」：{r['rating']} ⭐"
-                        if r['comment']:
-                            feedback += f"\n  💬 {r['comment']}"
-                    del pending_ratings[record.id]
-                    await admin.send(f"{header}{feedback}")
+                await api.send_batch(items)
+            except PeiPlayAPIError as e:
+                self.failed_batches_total += 1
+                if e.retryable:
+                    self._retry_later(rows)
+                    print(f"⚠️ Outbox 批次同步失敗（{len(rows)} 筆），稍後重試: {e}")
                 else:
-                    await admin.send(f"{header}\n⭐ 沒有收到任何評價。")
+                    self._dead_letter(rows, e.status)
+                    print(f"❌ Outbox 批次被 PeiPlay 拒絕（{len(rows)} 筆），已移到 dead-letter: {e}")
+                return sent
             except Exception as e:
-                print(f"推送管理區評價失敗：{e}")
+                self.failed_batches_total += 1
+                self._retry_later(rows)
+                print(f"⚠️ Outbox 批次同步失敗（{len(rows)} 筆），稍後重試: {e}")
+                return sent
+            self._ack([row[0] for row in rows])
+            sent += len(rows)
 
-        active_voice_channels.pop(vc_id, None)
-    except Exception as e:
-        print(f"❌ 倒數錯誤: {e}")
+    async def _run(self, api):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self.size:
+                await self.flush(api)
 
-# --- 指令：/createvc ---
-@bot.tree.command(name="createvc", description="建立匿名語音頻道（指定開始時間）", guild=discord.Object(id=GUILD_ID))
-@app_commands.describe(members="標註的成員們", minutes="存在時間（分鐘）", start_time="幾點幾分後啟動 (格式: HH:MM, 24hr)", limit="人數上限")
-async def createvc(interaction: discord.Interaction, members: str, minutes: int, start_time: str, limit: int = 2):
-    await interaction.response.defer()
-    try:
-        hour, minute = map(int, start_time.split(":"))
-        now = datetime.now(TW_TZ)
-        start_dt = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
-        if start_dt < now:
-            start_dt += timedelta(days=1)
-        start_dt_utc = start_dt.astimezone(timezone.utc)
-    except:
-        await interaction.followup.send("❗ 時間格式錯誤，請使用 HH:MM 24 小時制。")
-        return
+    def start(self, api):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(api))
 
-    # 解析成員名稱（假設格式是 "name1,name2" 或 "name1 name2"）
-    member_names = [name.strip() for name in members.replace(',', ' ').split() if name.strip()]
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
 
-    # 使用新的搜尋函數
-    mentioned = []
-    for name in member_names:
-        member = find_member_by_name(interaction.guild, name)
-        if member:
-            mentioned.append(member)
-        else:
-            await interaction.followup.send(f"❗ 找不到成員：{name}")
-            return
+# --- 配對歷史紀錄 ---
+class PairingHistory:
+    """已結束配對的本地紀錄與每位使用者的累計統計
 
-    if not mentioned:
-        await interaction.followup.send("❗ 請提供至少一位有效的成員名稱。")
-        return
+    結構沿用 discord-bot/create_pairing_records_table.sql 的 pairing_records，
+    統計在記錄寫入與收到評價時增量更新，查詢只需讀取一列。
+    """
 
-    animal = random.choice(ANIMALS)
-    animal_channel_name = f"{animal}頻道"
-    await interaction.followup.send(f"✅ 已排程配對頻道：{animal_channel_name} 將於 <t:{int(start_dt_utc.timestamp())}:t> 開啟")
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pairing_records (
+                id TEXT PRIMARY KEY,
+                user1_id TEXT NOT NULL,
+                user2_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                extended_times INTEGER DEFAULT 0,
+                duration INTEGER NOT NULL,
+                rating INTEGER,
+                comment TEXT,
+                animal_name TEXT NOT NULL,
+                booking_id TEXT UNIQUE NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_booking_id ON pairing_records(booking_id);
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_user1_id ON pairing_records(user1_id);
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_user2_id ON pairing_records(user2_id);
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_timestamp ON pairing_records(timestamp);
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_user1_timestamp ON pairing_records(user1_id, timestamp);
+            CREATE INDEX IF NOT EXISTS idx_pairing_records_user2_timestamp ON pairing_records(user2_id, timestamp);
 
-    async def countdown_wrapper():
-        await asyncio.sleep((start_dt_utc - datetime.now(timezone.utc)).total_seconds())
+            CREATE TABLE IF NOT EXISTS pairing_ratings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                record_id TEXT NOT NULL,
+                reviewer_id TEXT NOT NULL,
+                reviewee_id TEXT NOT NULL,
+                rating INTEGER NOT NULL,
+                comment TEXT,
+                created_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_pairing_ratings_record_id ON pairing_ratings(record_id);
 
-        overwrites = {
-            interaction.guild.default_role: discord.PermissionOverwrite(view_channel=False),
-            interaction.user: discord.PermissionOverwrite(view_channel=True, connect=True),
-        }
-        for m in mentioned:
-            overwrites[m] = discord.PermissionOverwrite(view_channel=True, connect=True)
+            CREATE TABLE IF NOT EXISTS pairing_attendance (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                record_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                joined_at TEXT NOT NULL,
+                left_at TEXT NOT NULL,
+                seconds INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_pairing_attendance_record_id ON pairing_attendance(record_id);
 
-        category = discord.utils.get(interaction.guild.categories, name="語音頻道")
-        vc = await interaction.guild.create_voice_channel(name=animal_channel_name, overwrites=overwrites, user_limit=limit, category=category)
-        text_channel = await interaction.guild.create_text_channel(name="🔒匿名文字區", overwrites=overwrites, category=category)
+            CREATE TABLE IF NOT EXISTS pairing_user_stats (
+                user_id TEXT PRIMARY KEY,
+                pairing_count INTEGER DEFAULT 0,
+                rating_sum INTEGER DEFAULT 0,
+                rating_count INTEGER DEFAULT 0,
+                comment_count INTEGER DEFAULT 0
+            );
+        """)
 
-        # 創建本地記錄
-        record = DiscordPairingRecord(
-            user1_id=str(interaction.user.id),
-            user2_id=str(mentioned[0].id),
-            duration=minutes * 60,
-            animal_name=animal
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    def _transaction(self, statements):
+        self.conn.execute("BEGIN")
+        try:
+            for sql, params in statements:
+                self.conn.execute(sql, params)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _iso(ts: float):
+        return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds")
+
+    def save_record(self, record):
+        """寫入已結束的配對與出席時段，並累加雙方的配對次數"""
+        now = self._now()
+        bump = (
+            "INSERT INTO pairing_user_stats (user_id, pairing_count) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET pairing_count = pairing_count + 1"
         )
+        attendance = [
+            ("INSERT INTO pairing_attendance (record_id, user_id, joined_at, left_at, seconds) VALUES (?, ?, ?, ?, ?)",
+             (record.id, user_id, self._iso(joined), self._iso(left), round(left - joined)))
+            for user_id, spans in record.attendance.items()
+            for joined, left in spans if left is not None
+        ]
+        self._transaction(attendance + [
+            ("INSERT INTO pairing_records (id, user1_id, user2_id, timestamp, extended_times, duration, rating, comment, "
+             "animal_name, booking_id, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+             (record.id, record.user1_id, record.user2_id,
+              record.created_at.astimezone(timezone.utc).isoformat(timespec="seconds"),
+              record.extended_times, record.duration, record.rating, record.comment, record.animal_name,
+              record.peiplay_booking_id or record.id, now, now)),
+            (bump, (record.user1_id,)),
+            (bump, (record.user2_id,)),
+        ])
 
-        # 嘗試創建 PeiPlay booking
-        peiplay_api = PeiPlayAPI(PEIPLAY_API_URL)
-        peiplay_booking = peiplay_api.create_discord_booking(
-            user1_id=str(interaction.user.id),
+    def add_rating(self, record_id: str, reviewer_id: str, reviewee_id: str, rating: int, comment: str = None):
+        """寫入一筆評價，並累加被評價者的評分與留言統計"""
+        now = self._now()
+        self._transaction([
+            ("INSERT INTO pairing_ratings (record_id, reviewer_id, reviewee_id, rating, comment, created_at) "
+             "VALUES (?, ?, ?, ?, ?, ?)", (record_id, reviewer_id, reviewee_id, rating, comment, now)),
+            ("UPDATE pairing_records SET rating = ?, comment = ?, updated_at = ? WHERE id = ?",
+             (rating, comment, now, record_id)),
+            ("INSERT INTO pairing_user_stats (user_id, rating_sum, rating_count, comment_count) VALUES (?, ?, 1, ?) "
+             "ON CONFLICT(user_id) DO UPDATE SET rating_sum = rating_sum + excluded.rating_sum, "
+             "rating_count = rating_count + 1, comment_count = comment_count + excluded.comment_count",
+             (reviewee_id, rating, 1 if comment else 0)),
+        ])
+
+    def rating_total(self):
+        return self.conn.execute("SELECT COUNT(*) FROM pairing_ratings").fetchone()[0]
+
+    def user_stats(self, user_id: str):
+        row = self.conn.execute(
+            "SELECT pairing_count, rating_sum, rating_count, comment_count FROM pairing_user_stats WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        count, rating_sum, rating_count, comment_count = row or (0, 0, 0, 0)
+        return {
+            "count": count,
+            "avg_rating": round(rating_sum / rating_count, 1) if rating_count else None,
+            "comment_count": comment_count,
+        }
+
+local_db = open_local_db(BOT_DB_PATH)
+outbox = Outbox(local_db)
+pairing_history = PairingHistory(local_db)
+
+# --- 配對紀錄匯出 ---
+class PairingExport:
+    """把配對紀錄、評價與留言匯出成 CSV / XLSX
+
+    在背景執行緒以獨立的 SQLite 連線分批讀取（WAL 下不會擋住 bot 的寫入），
+    每次只保留 EXPORT_CHUNK_ROWS 列；CSV 邊讀邊送出，XLSX 以 openpyxl 的
+    write-only 模式寫到暫存檔，記憶體用量與列數無關。
+
+    留言是成員自由輸入的文字：CSV 中以公式字元開頭的欄位前面加上 '，
+    XLSX 則一律以字串型別寫入，避免在管理員的 Excel 裡被當成公式執行。
+    """
+
+    FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+    COLUMNS = ("record_id", "timestamp", "user1_id", "user2_id", "animal_name", "duration", "extended_times",
+               "booking_id", "user1_attended_seconds", "user2_attended_seconds",
+               "reviewer_id", "reviewee_id", "rating", "comment", "rated_at")
+
+    QUERY = """
+        SELECT r.id, r.timestamp, r.user1_id, r.user2_id, r.animal_name, r.duration, r.extended_times, r.booking_id,
+               (SELECT COALESCE(SUM(a.seconds), 0) FROM pairing_attendance a WHERE a.record_id = r.id AND a.user_id = r.user1_id),
+               (SELECT COALESCE(SUM(a.seconds), 0) FROM pairing_attendance a WHERE a.record_id = r.id AND a.user_id = r.user2_id),
+               g.reviewer_id, g.reviewee_id, g.rating, g.comment, g.created_at
+        FROM pairing_records r
+        LEFT JOIN pairing_ratings g ON g.record_id = r.id
+        WHERE r.timestamp >= ? AND r.timestamp < ? {user_filter}
+        ORDER BY r.timestamp, r.id, g.id
+    """
+
+    def __init__(self, db_path: str = BOT_DB_PATH, chunk_rows: int = EXPORT_CHUNK_ROWS):
+        self.db_path = db_path
+        self.chunk_rows = chunk_rows
+
+    @staticmethod
+    def parse_range(start: str, end: str):
+        """YYYY-MM-DD（台灣時間）→ UTC ISO 範圍 [start, end + 1 天)"""
+        try:
+            start_dt = datetime.strptime(start, "%Y-%m-%d").replace(tzinfo=TW_TZ)
+            end_dt = datetime.strptime(end, "%Y-%m-%d").replace(tzinfo=TW_TZ) + timedelta(days=1)
+        except (TypeError, ValueError):
+            raise ValueError("日期格式錯誤，請使用 YYYY-MM-DD")
+        if end_dt <= start_dt:
+            raise ValueError("結束日期不可早於開始日期")
+        iso = lambda dt: dt.astimezone(timezone.utc).isoformat(timespec="seconds")
+        return iso(start_dt), iso(end_dt)
+
+    @staticmethod
+    def filename(fmt: str, start: str, end: str):
+        return f"pairings_{start}_{end}.{fmt}"
+
+    def rows(self, start_iso: str, end_iso: str, user_id: str = None):
+        """依時間（與使用者）篩選，分批讀出；必須在同一個執行緒內迭代完"""
+        params = [start_iso, end_iso]
+        user_filter = ""
+        if user_id:
+            user_filter = "AND (r.user1_id = ? OR r.user2_id = ?)"
+            params += [user_id, user_id]
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute(self.QUERY.format(user_filter=user_filter), params)
+            while True:
+                batch = cursor.fetchmany(self.chunk_rows)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            conn.close()
+
+    @classmethod
+    def _csv_safe(cls, row):
+        return [f"'{value}" if isinstance(value, str) and value.startswith(cls.FORMULA_PREFIXES) else value
+                for value in row]
+
+    def csv_chunks(self, start_iso: str, end_iso: str, user_id: str = None, chunk_bytes: int = 64 * 1024):
+        """產生 UTF-8（含 BOM，Excel 才會正確顯示中文）的 CSV 區塊"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write("\ufeff")
+        writer.writerow(self.COLUMNS)
+        for row in self.rows(start_iso, end_iso, user_id):
+            writer.writerow(self._csv_safe(row))
+            if buffer.tell() >= chunk_bytes:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode("utf-8")
+
+    def write_file(self, fmt: str, start_iso: str, end_iso: str, user_id: str = None):
+        """寫入暫存檔並回傳路徑（阻塞，請在執行緒中呼叫）；呼叫端負責刪除檔案"""
+        fd, path = tempfile.mkstemp(prefix="peiplay_export_", suffix=f".{fmt}")
+        try:
+            if fmt == "xlsx":
+                os.close(fd)
+                import openpyxl  # 選用套件，只有匯出 XLSX 時才需要
+                from openpyxl.cell import WriteOnlyCell
+                workbook = openpyxl.Workbook(write_only=True)
+                sheet = workbook.create_sheet("配對紀錄")
+                sheet.append(self.COLUMNS)
+                for row in self.rows(start_iso, end_iso, user_id):
+                    cells = []
+                    for value in row:
+                        cell = WriteOnlyCell(sheet, value=value)
+                        if isinstance(value, str):
+                            cell.data_type = "s"   # openpyxl 會把 "=" 開頭的字串存成公式
+                        cells.append(cell)
+                    sheet.append(cells)
+                workbook.save(path)
+            else:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in self.csv_chunks(start_iso, end_iso, user_id):
+                        f.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path
+
+    async def stream_csv(self, start_iso: str, end_iso: str, user_id: str = None, max_chunks: int = 4):
+        """在執行緒中產生 CSV，以有上限的佇列交回事件迴圈（消費端慢時產生端會等待）"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_chunks)
+        cancelled = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in self.csv_chunks(start_iso, end_iso, user_id):
+                    if cancelled.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(queue.put(chunk), loop).result()
+            except Exception as e:
+                asyncio.run_coroutine_threadsafe(queue.put(e), loop).result()
+            else:
+                asyncio.run_coroutine_threadsafe(queue.put(done), loop).result()
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            while not producer.done():
+                # 讓卡在 put 的產生端結束
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+pairing_export = PairingExport()
+
+# --- 本地配對記錄 ---
+class DiscordPairingRecord:
+    __slots__ = ("id", "user1_id", "user2_id", "duration", "animal_name", "extended_times",
+                 "rating", "comment", "created_at", "peiplay_booking_id", "attendance")
+
+    def __init__(self, user1_id: str, user2_id: str, duration: int, animal_name: str):
+        self.id = f"discord_{datetime.now().timestamp()}_{secrets.token_hex(3)}"
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.duration = duration
+        self.animal_name = animal_name
+        self.extended_times = 0
+        self.rating = None
+        self.comment = None
+        self.created_at = datetime.now()
+        self.peiplay_booking_id = None
+        self.attendance = {}    # user_id -> [[進入時間, 離開時間或 None], ...]（epoch 秒）
+
+    def join(self, user_id: str, ts: float):
+        spans = self.attendance.setdefault(user_id, [])
+        if not spans or spans[-1][1] is not None:
+            spans.append([ts, None])
+
+    def leave(self, user_id: str, ts: float):
+        spans = self.attendance.get(user_id)
+        if spans and spans[-1][1] is None:
+            spans[-1][1] = ts
+
+    def present(self):
+        """目前仍在語音頻道內的參與者"""
+        return [user_id for user_id, spans in self.attendance.items() if spans[-1][1] is None]
+
+    def close_attendance(self, ts: float):
+        for user_id in self.present():
+            self.leave(user_id, ts)
+
+    def attended_seconds(self, user_id: str):
+        now = time.time()
+        return sum((left or now) - joined for joined, left in self.attendance.get(user_id, ()))
+
+    def to_dict(self):
+        data = {name: getattr(self, name) for name in self.__slots__}
+        data["created_at"] = self.created_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, data.get(name))
+        record.created_at = datetime.fromisoformat(data["created_at"])
+        record.attendance = record.attendance or {}
+        return record
+
+# --- 配對工作階段 ---
+class PairingSession:
+    """一個進行中的配對（語音 + 文字頻道、記錄、收到的評價）"""
+
+    __slots__ = ("job_id", "vc", "text_channel", "record", "participant_ids", "duration", "extended",
+                 "on_warning", "ratings", "ended_at", "abandoned")
+
+    def __init__(self, vc, text_channel, record, participant_ids, duration: int, job_id: str = None):
+        self.job_id = job_id
+        self.vc = vc
+        self.text_channel = text_channel
+        self.record = record
+        self.participant_ids = tuple(participant_ids)
+        self.duration = duration
+        self.extended = 0
+        self.on_warning = None
+        self.ratings = []
+        self.ended_at = None
+        self.abandoned = False
+
+    @property
+    def vc_id(self):
+        return self.vc.id
+
+    @property
+    def text_channel_id(self):
+        return self.text_channel.id
+
+    @property
+    def record_id(self):
+        return self.record.id
+
+class SessionRegistry:
+    """以語音頻道、文字頻道、記錄 ID、參與者建立索引的工作階段登錄表
+
+    所有查詢都是 O(1)；語音結束後的工作階段與已評價記錄在 TTL 到期後自動移除，
+    不會隨著執行時間無限成長。
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL_SECONDS):
+        self.ttl = ttl
+        self._by_vc = {}
+        self._by_text = {}
+        self._by_record = {}
+        self._by_user = {}              # user_id -> {vc_id}
+        self._ended = OrderedDict()     # vc_id -> 語音結束時間（依序到期）
+        self._evaluated = OrderedDict() # record_id -> 評價時間
+        self.rating_count = 0
+
+    def __len__(self):
+        return len(self._by_vc)
+
+    def __contains__(self, vc_id):
+        return vc_id in self._by_vc
+
+    def add(self, session: PairingSession):
+        self.evict_expired()
+        self._by_vc[session.vc_id] = session
+        self._by_text[session.text_channel_id] = session
+        self._by_record[session.record_id] = session
+        for user_id in session.participant_ids:
+            self._by_user.setdefault(user_id, set()).add(session.vc_id)
+
+    def remove(self, session: PairingSession):
+        if self._by_vc.get(session.vc_id) is not session:
+            return
+        del self._by_vc[session.vc_id]
+        self._by_text.pop(session.text_channel_id, None)
+        self._by_record.pop(session.record_id, None)
+        self._ended.pop(session.vc_id, None)
+        self.rating_count -= len(session.ratings)
+        for user_id in session.participant_ids:
+            vc_ids = self._by_user.get(user_id)
+            if vc_ids:
+                vc_ids.discard(session.vc_id)
+                if not vc_ids:
+                    del self._by_user[user_id]
+
+    def get_by_vc(self, vc_id):
+        return self._by_vc.get(vc_id)
+
+    def get_by_text(self, text_channel_id):
+        return self._by_text.get(text_channel_id)
+
+    def get_by_record(self, record_id):
+        return self._by_record.get(record_id)
+
+    def sessions_for_user(self, user_id):
+        return [self._by_vc[vc_id] for vc_id in self._by_user.get(user_id, ())]
+
+    def mark_ended(self, session: PairingSession):
+        """語音結束，進入評價階段；TTL 到期後即使倒數異常也會被移除"""
+        session.ended_at = time.monotonic()
+        self._ended[session.vc_id] = session.ended_at
+
+    def add_rating(self, session: PairingSession, rating: dict):
+        session.ratings.append(rating)
+        self.rating_count += 1
+        self._evaluated[session.record_id] = time.monotonic()
+        self._evaluated.move_to_end(session.record_id)
+
+    @property
+    def evaluated_count(self):
+        return len(self._evaluated)
+
+    def evict_expired(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._ended:
+            vc_id, ended_at = next(iter(self._ended.items()))
+            if ended_at > cutoff:
+                break
+            session = self._by_vc.get(vc_id)
+            if session:
+                self.remove(session)
+            else:
+                self._ended.pop(vc_id)
+        while self._evaluated:
+            record_id, evaluated_at = next(iter(self._evaluated.items()))
+            if evaluated_at > cutoff:
+                break
+            self._evaluated.pop(record_id)
+
+# --- 倒數排程器 ---
+class DeadlineScheduler:
+    """所有頻道共用的截止時間排程器（heap + 單一計時器）
+
+    每個 (key, kind) 只保留一個有效的截止時間；重新排程時舊的 heap 項目
+    直接作廢（lazy deletion），因此排程、延長、取消都是 O(log n)。
+    事件迴圈只會在最早的截止時間到達時被喚醒一次。
+    """
+
+    def __init__(self):
+        self._heap = []        # (when, seq, key, kind)
+        self._entries = {}     # key -> {kind: (when, seq, callback)}
+        self._count = 0
+        self._seq = itertools.count()
+        self._timer = None
+        self._timer_when = None
+        self._tasks = set()    # coroutine 回呼產生的 task（保留參照，結束時記錄例外）
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, key, kind, when: float, callback):
+        """設定（或覆寫）某個 key 的截止時間，when 為 loop.time() 時間"""
+        seq = next(self._seq)
+        kinds = self._entries.setdefault(key, {})
+        if kind not in kinds:
+            self._count += 1
+        kinds[kind] = (when, seq, callback)
+        heapq.heappush(self._heap, (when, seq, key, kind))
+        self._compact()
+        self._arm()
+
+    def reschedule(self, key, kind, when: float):
+        """移動既有的截止時間，沿用原本的 callback"""
+        entry = self._entries.get(key, {}).get(kind)
+        if entry is None:
+            return False
+        self.schedule(key, kind, when, entry[2])
+        return True
+
+    def deadline(self, key, kind):
+        entry = self._entries.get(key, {}).get(kind)
+        return entry[0] if entry else None
+
+    def remaining(self, key, kind="end"):
+        when = self.deadline(key, kind)
+        if when is None:
+            return None
+        return max(0.0, when - asyncio.get_running_loop().time())
+
+    def cancel(self, key, kind=None):
+        """取消 key 的某個（或全部）截止時間"""
+        kinds = self._entries.get(key)
+        if not kinds:
+            return
+        if kind is None:
+            self._count -= len(kinds)
+            del self._entries[key]
+        elif kinds.pop(kind, None) is not None:
+            self._count -= 1
+            if not kinds:
+                del self._entries[key]
+        self._compact()
+        self._arm()
+
+    def _pop(self, key, kind):
+        kinds = self._entries[key]
+        entry = kinds.pop(kind)
+        self._count -= 1
+        if not kinds:
+            del self._entries[key]
+        return entry
+
+    def _compact(self):
+        # 作廢項目超過一半時重建 heap，避免頻繁延長讓 heap 無限成長
+        if len(self._heap) > 64 and len(self._heap) > 2 * self._count:
+            self._heap = [
+                (when, seq, key, kind)
+                for key, kinds in self._entries.items()
+                for kind, (when, seq, _) in kinds.items()
+            ]
+            heapq.heapify(self._heap)
+
+    def _is_live(self, item):
+        when, seq, key, kind = item
+        entry = self._entries.get(key, {}).get(kind)
+        return entry is not None and entry[1] == seq
+
+    def _arm(self):
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+        if not self._heap:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = self._timer_when = None
+            return
+        when = self._heap[0][0]
+        if self._timer and self._timer_when == when:
+            return
+        if self._timer:
+            self._timer.cancel()
+        self._timer_when = when
+        # 以全新的 context 觸發：否則會沿用最後一次排程者的 contextvars，
+        # 場次流程的 span 會掛在當初下指令的 trace 底下，而不是自成一棵樹
+        self._timer = asyncio.get_running_loop().call_at(when, self._fire, context=contextvars.Context())
+
+    def _fire(self):
+        self._timer = self._timer_when = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            if not self._is_live(item):
+                continue
+            when, _, key, kind = item
+            _, _, callback = self._pop(key, kind)
+            countdown_drift.observe(now - when, kind)
+            try:
+                result = callback()
+                if asyncio.iscoroutine(result):
+                    task = loop.create_task(result)
+                    self._tasks.add(task)
+                    task.add_done_callback(functools.partial(self._task_done, key, kind))
+            except Exception as e:
+                print(f"❌ 排程回呼錯誤 ({key}, {kind}): {e}")
+        self._arm()
+
+    def _task_done(self, key, kind, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        e = task.exception()
+        if e is not None:
+            print(f"❌ 排程回呼錯誤 ({key}, {kind}): {e!r}")
+            traceback.print_exception(e)
+
+def loop_time_at(ts: float):
+    """將 wall-clock 時間戳轉成 loop.time()，用於從日誌恢復的截止時間"""
+    return asyncio.get_running_loop().time() + (ts - time.time())
+
+def wall_time_at(when: float):
+    return time.time() + (when - asyncio.get_running_loop().time())
+
+session_scheduler = DeadlineScheduler()
+sessions = SessionRegistry()
+
+# --- 排程日誌 ---
+class ScheduleJournal:
+    """排程與進行中場次的持久化日誌（append-only JSON lines + 定期快照）
+
+    每個事件都是冪等的狀態更新，啟動時讀取快照再套用日誌尾端即可一次重建狀態；
+    快照寫入後日誌歸零，讓重啟時需要重播的內容維持在固定大小以內。
+    """
+
+    def __init__(self, path: str = JOURNAL_PATH, snapshot_every: int = JOURNAL_SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_path = f"{path}.snapshot"
+        self.snapshot_every = snapshot_every
+        self.jobs = {}      # job_id -> 目前狀態
+        self.resumed = False
+        self._file = None
+        self._entries = 0
+
+    def load(self):
+        started = time.perf_counter()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                self.jobs = json.load(f)["jobs"]
+        if os.path.exists(self.path):
+            with open(self.path, "r+b") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 崩潰時寫到一半的最後一行：截掉，避免接在後面的新記錄也一起損毀
+                        f.truncate(offset)
+                        break
+                    self._apply(entry)
+                    self._entries += 1
+                    offset += len(line)
+        self._file = open(self.path, "a", encoding="utf-8")
+        elapsed = (time.perf_counter() - started) * 1000
+        print(f"📒 排程日誌已載入：{len(self.jobs)} 筆排程（{elapsed:.0f} ms）")
+
+    def _apply(self, entry: dict):
+        event, job_id = entry["event"], entry["job_id"]
+        if event == "schedule":
+            self.jobs[job_id] = {k: v for k, v in entry.items() if k != "event"}
+            self.jobs[job_id]["phase"] = "scheduled"
+        elif event in ("finish", "cancel"):
+            self.jobs.pop(job_id, None)
+        elif job_id in self.jobs:
+            self.jobs[job_id].update({k: v for k, v in entry.items() if k not in ("event", "job_id")})
+
+    def record(self, event: str, job_id: str, **fields):
+        entry = {"event": event, "job_id": job_id, **fields}
+        self._apply(entry)
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._entries += 1
+        if self._entries >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"jobs": self.jobs}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self._file:
+            self._file.close()
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._entries = 0
+
+    def close(self):
+        if self._file:
+            self.snapshot()
+            self._file.close()
+            self._file = None
+
+journal = ScheduleJournal()
+
+# --- 使用者快取 ---
+class UserResolver:
+    """解析 Discord 使用者：gateway 快取 → TTL/LRU 快取 → 去重後的單次 REST 查詢"""
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache = OrderedDict()   # user_id -> (expires_at, user)
+        self._inflight = {}           # user_id -> Task
+        self.gateway_hits = 0
+        self.cache_hits = 0
+        self.fetches = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    async def resolve(self, user_id: int):
+        user = bot.get_user(user_id)
+        if user is not None:
+            self.gateway_hits += 1
+            return user
+
+        cached = self._cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            self._cache.move_to_end(user_id)
+            self.cache_hits += 1
+            return cached[1]
+
+        task = self._inflight.get(user_id)
+        if task is None:
+            self.fetches += 1
+            task = asyncio.get_running_loop().create_task(bot.fetch_user(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        user = await asyncio.shield(task)
+
+        self._cache[user_id] = (time.monotonic() + self.ttl, user)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return user
+
+user_resolver = UserResolver()
+
+# --- 管理區回報 ---
+def admin_channel():
+    """管理頻道；所在伺服器不由本行程連線時（多行程部署）改用 partial messageable 直接以 REST 送出"""
+    if not ADMIN_CHANNEL_ID:
+        return None
+    return bot.get_channel(ADMIN_CHANNEL_ID) or bot.get_partial_messageable(ADMIN_CHANNEL_ID)
+
+class AdminReporter:
+    """推送配對紀錄到管理頻道
+
+    ADMIN_DIGEST_INTERVAL > 0 時，期間內的回報會合併成一則摘要訊息再送出，
+    避免每場配對各自呼叫一次 admin.send。
+    """
+
+    MAX_MESSAGE_LENGTH = 2000
+
+    def __init__(self, interval: float = ADMIN_DIGEST_INTERVAL):
+        self.interval = interval
+        self._pending = []
+        self._task = None
+
+    async def send(self, content: str):
+        if self.interval <= 0:
+            admin = admin_channel()
+            if admin:
+                message_queue.post(admin, content, priority=MessageQueue.LOW)
+            return
+        self._pending.append(content)
+
+    def _chunks(self, entries):
+        chunk = ""
+        for entry in entries:
+            entry = entry[:self.MAX_MESSAGE_LENGTH]
+            if chunk and len(chunk) + len(entry) + 2 > self.MAX_MESSAGE_LENGTH:
+                yield chunk
+                chunk = ""
+            chunk = f"{chunk}\n\n{entry}" if chunk else entry
+        if chunk:
+            yield chunk
+
+    async def flush(self):
+        if not self._pending:
+            return
+        entries, self._pending = self._pending, []
+        admin = admin_channel()
+        if not admin:
+            return
+        for chunk in self._chunks(entries):
+            message_queue.post(admin, chunk, priority=MessageQueue.LOW)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+admin_reporter = AdminReporter()
+
+# --- 評分 Modal ---
+class RatingModal(Modal, title="匿名評分與留言"):
+    rating = TextInput(label="給予評分（1～5 星）", required=True)
+    comment = TextInput(label="留下你的留言（選填）", required=False)
+
+    def __init__(self, record_id):
+        super().__init__()
+        self.record_id = record_id
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            rating = int(str(self.rating))
+            if rating < 1 or rating > 5:
+                await interaction.response.send_message("❌ 評分必須在 1-5 之間。", ephemeral=True)
+                return
+                
+            comment = str(self.comment) if self.comment else None
+            
+            # 找到對應的記錄
+            session = sessions.get_by_record(self.record_id)
+            record = session.record if session else None
+            
+            if record:
+                record.rating = rating
+                record.comment = comment
+                
+                # 創建 PeiPlay review
+                reviewer_id = str(interaction.user.id)
+                reviewee_id = record.user2_id if reviewer_id == record.user1_id else record.user1_id
+                
+                # 先存本地；同步到 PeiPlay 失敗（例如 outbox 已滿）不影響評價本身
+                pairing_history.add_rating(record.id, reviewer_id, reviewee_id, rating, comment)
+                sessions.add_rating(session, {
+                    'rating': rating,
+                    'comment': comment,
+                    'user1': reviewer_id,
+                    'user2': reviewee_id
+                })
+                review_result = await peiplay_api.create_discord_review(
+                    booking_id=record.id,
+                    reviewer_id=reviewer_id,
+                    reviewee_id=reviewee_id,
+                    rating=rating,
+                    comment=comment
+                )
+                if not (review_result and review_result.get('success')):
+                    print(f"⚠️ 評價已存本地，但未能排入 PeiPlay 同步：{record.id}")
+                await interaction.response.send_message("✅ 感謝你的匿名評價！", ephemeral=True)
+            else:
+                await interaction.response.send_message("❌ 找不到對應的配對記錄。", ephemeral=True)
+                
+        except ValueError:
+            await interaction.response.send_message("❌ 請輸入有效的數字評分。", ephemeral=True)
+        except Exception as e:
+            await interaction.response.send_message(f"❌ 提交失敗：{e}", ephemeral=True)
+
+# --- 延長按鈕 ---
+class ExtendView(View):
+    def __init__(self, vc_id):
+        super().__init__(timeout=None)
+        self.vc_id = vc_id
+        # 固定 custom_id，重啟後可用 bot.add_view 重新接上原本的按鈕
+        self.extend_button.custom_id = f"peiplay:extend:{vc_id}"
+
+    @discord.ui.button(label="🔁 延長 10 分鐘", style=discord.ButtonStyle.primary)
+    async def extend_button(self, interaction: discord.Interaction, button: Button):
+        session = sessions.get_by_vc(self.vc_id)
+        if session is None:
+            await interaction.response.send_message("❗ 頻道資訊不存在或已刪除。", ephemeral=True)
+            return
+        end = session_scheduler.deadline(self.vc_id, "end")
+        if end is None:
+            await interaction.response.send_message("❗ 頻道已結束，無法延長。", ephemeral=True)
+            return
+        end += EXTEND_SECONDS
+        session_scheduler.reschedule(self.vc_id, "end", end)
+        session_scheduler.schedule(self.vc_id, "warning", end - WARNING_SECONDS, session.on_warning)
+        session.extended += 1
+        if session.job_id:
+            journal.record("extend", session.job_id, end_ts=wall_time_at(end), extended=session.extended)
+        await interaction.response.send_message("⏳ 已延長 10 分鐘。", ephemeral=True)
+
+# --- Bot 啟動 ---
+class StartupTimer:
+    """冷啟動各階段與 Gateway 重新連線的耗時"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = []            # (階段, 秒)
+        self.ready_seconds = None
+        self.disconnected_at = None
+        self._last = started
+
+    def mark(self, phase: str):
+        if self.ready_seconds is not None:
+            return
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def ready(self):
+        if self.ready_seconds is not None:
+            return
+        self.ready_seconds = time.perf_counter() - self.started
+        phases = "、".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases)
+        print(f"⏱️ 啟動完成，共 {self.ready_seconds:.2f} 秒：{phases}")
+
+    def disconnected(self):
+        if self.disconnected_at is None:
+            self.disconnected_at = time.perf_counter()
+
+    def reconnected(self, kind: str):
+        if self.disconnected_at is None:
+            return
+        seconds = time.perf_counter() - self.disconnected_at
+        self.disconnected_at = None
+        gateway_reconnect.observe(seconds, kind)
+        print(f"🔁 Gateway 已恢復（{kind}），斷線 {seconds:.2f} 秒")
+
+startup = StartupTimer(MODULE_STARTED)
+
+class CommandSyncCache:
+    """記錄每個伺服器上次同步的指令樹指紋，指令沒有變更時略過 tree.sync"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS command_sync (
+                guild_id INTEGER PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                synced_at TEXT NOT NULL
+            )
+        """)
+
+    @staticmethod
+    def fingerprint(tree, guild):
+        commands = sorted((command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+                          key=lambda command: (command["type"], command["name"]))
+        payload = json.dumps([tree.client.application_id, commands], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def is_current(self, guild_id: int, fingerprint: str):
+        row = self.conn.execute("SELECT fingerprint FROM command_sync WHERE guild_id = ?", (guild_id,)).fetchone()
+        return row is not None and row[0] == fingerprint
+
+    def store(self, guild_id: int, fingerprint: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO command_sync (guild_id, fingerprint, synced_at) VALUES (?, ?, ?)",
+            (guild_id, fingerprint, datetime.now(timezone.utc).isoformat(timespec="seconds")),
+        )
+
+command_sync_cache = CommandSyncCache(local_db)
+
+async def sync_commands(guild):
+    """tree.sync 是有速率限制的 REST 呼叫，指令樹與上次同步相同時直接略過"""
+    fingerprint = command_sync_cache.fingerprint(bot.tree, guild)
+    if not FORCE_COMMAND_SYNC and command_sync_cache.is_current(guild.id, fingerprint):
+        print(f"✅ Slash 指令未變更，略過同步（{guild.name}）")
+        return
+    try:
+        synced = await bot.tree.sync(guild=guild)
+    except Exception as e:
+        print(f"❌ 指令同步失敗（{guild.name}）: {e}")
+        return
+    command_sync_cache.store(guild.id, fingerprint)
+    print(f"✅ Slash 指令已同步（{guild.name}）：{len(synced)} 個指令")
+
+@bot.event
+async def on_ready():
+    startup.mark("登入並連線 Gateway")
+    startup.reconnected("ready")
+    print(f"✅ Bot 上線：{bot.user}")
+    print(f"🌐 PeiPlay API URL: {PEIPLAY_API_URL}")
+    for g in bot.guilds:
+        await member_index.build(g)
+    startup.mark("建立成員索引")
+    if not journal.resumed:
+        journal.resumed = True
+        resume_jobs()
+        startup.mark("恢復排程")
+    guilds = [g for g in bot.guilds if g.id in GUILD_IDS]
+    for guild in guilds:
+        channel_pool_for(guild.id).start(guild)
+    if not isinstance(shared_state, MemoryStateBackend):
+        # 單一行程時沒有其他行程會轉交指令，不需要輪詢信箱
+        command_mailbox.start()
+    for guild in guilds:
+        await sync_commands(guild)
+    startup.mark("同步指令")
+    startup.ready()
+
+@bot.event
+async def on_disconnect():
+    startup.disconnected()
+
+@bot.event
+async def on_resumed():
+    startup.reconnected("resume")
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    interaction_latency.observe((discord.utils.utcnow() - interaction.created_at).total_seconds(),
+                                command.qualified_name)
+
+@bot.event
+async def on_member_join(member):
+    member_index.add(member)
+
+@bot.event
+async def on_member_remove(member):
+    member_index.remove(member)
+
+@bot.event
+async def on_member_update(before, after):
+    member_index.update(after)
+
+@bot.event
+async def on_user_update(before, after):
+    # 使用者名稱 / 全域名稱變更會影響所有共同伺服器的索引
+    for g in bot.guilds:
+        member = g.get_member(after.id)
+        if member:
+            member_index.update(member)
+
+@bot.event
+async def on_message(message):
+    if message.author == bot.user:
+        return
+    if message.content == "!ping":
+        await message.channel.send("Pong!")
+    await bot.process_commands(message)
+
+# --- 倒數邏輯 ---
+async def countdown(session: PairingSession, members=(), end_ts: float = None, rating_end_ts: float = None):
+    """場次流程：開場 → 語音倒數 → 評分 → 回報；end_ts / rating_end_ts 用於重啟後續接"""
+    vc, text_channel, record = session.vc, session.text_channel, session.record
+    vc_id = vc.id
+    try:
+        if rating_end_ts is None:
+            if end_ts is None:
+                with tracer.span("session.open"):
+                    with tracer.span("move"):
+                        await move_members([
+                            (user.id, vc.id) for user in members
+                            if user.voice and user.voice.channel
+                        ])
+
+                    view = ExtendView(vc.id)
+                    with tracer.span("send.open"):
+                        message = await message_queue.send(text_channel, f"🎉 語音頻道 {record.animal_name}頻道 已開啟！\n⏳ 可延長10分鐘 ( 為了您有更好的遊戲體驗，請到最後需要時再點選 ) 。", view=view)
+                    end_ts = time.time() + session.duration
+                    journal.record("open", session.job_id, message_id=message.id, end_ts=end_ts)
+
+            loop = asyncio.get_running_loop()
+            ended = loop.create_future()
+
+            def on_warning():
+                message_queue.post(text_channel, "⏰ 剩餘 1 分鐘。", priority=MessageQueue.URGENT)
+
+            def on_end():
+                if not ended.done():
+                    ended.set_result(None)
+
+            end = loop_time_at(end_ts)
+            session.on_warning = on_warning
+            session_scheduler.schedule(vc_id, "warning", end - WARNING_SECONDS, on_warning)
+            session_scheduler.schedule(vc_id, "end", end, on_end)
+            # 只有曾經有人進來、之後全部離開才提前結束；遲到的人不會因此失去已預約的場次
+            if record.attendance and not record.present():
+                arm_empty_timer(session, EMPTY_SESSION_GRACE_SECONDS)
+            elif not record.attendance and NO_SHOW_GRACE_SECONDS > 0:
+                arm_empty_timer(session, NO_SHOW_GRACE_SECONDS)
+            try:
+                await ended
+            finally:
+                session_scheduler.cancel(vc_id)
+
+            # 先標記結束，回收頻道時把成員移出不會再記成出席變化
+            record.close_attendance(time.time())
+            sessions.mark_ended(session)
+            with tracer.span("session.voice_end"):
+                await channel_pool_for(vc.guild.id).release_voice(vc)
+            shared_state.unregister_channel(vc_id)
+
+            record.extended_times = session.extended
+            record.duration += record.extended_times * 600
+            try:
+                pairing_history.save_record(record)
+            except Exception as e:
+                print(f"❌ 配對紀錄寫入失敗: {e}")
+            await peiplay_api.report_discord_attendance(record.id, record.attendance)
+
+            rating_end_ts = time.time() + RATING_WINDOW_SECONDS
+            journal.record("voice_end", session.job_id, phase="rating", rating_end_ts=rating_end_ts,
+                           record=record.to_dict())
+
+        message_queue.post(text_channel, "📝 請點擊以下按鈕進行匿名評分。")
+
+        class SubmitButton(View):
+            def __init__(self, timeout):
+                super().__init__(timeout=timeout)
+                self.clicked = False
+
+            @discord.ui.button(label="匿名評分", style=discord.ButtonStyle.success)
+            async def submit(self, interaction: discord.Interaction, button: Button):
+                if self.clicked:
+                    await interaction.response.send_message("❗ 已提交過評價。", ephemeral=True)
+                    return
+                self.clicked = True
+                await interaction.response.send_modal(RatingModal(record.id))
+
+        remaining = max(0.0, rating_end_ts - time.time())
+        # 與上面的提示合併成同一則訊息
+        await message_queue.send(text_channel, view=SubmitButton(remaining))
+        await asyncio.sleep(remaining)
+        with tracer.span("session.rating_end"):
+            await channel_pool_for(text_channel.guild.id).release_text(text_channel)
+
+        if ADMIN_CHANNEL_ID:
+            try:
+                u1 = await user_resolver.resolve(int(record.user1_id))
+                u2 = await user_resolver.resolve(int(record.user2_id))
+                header = f"📋 配對紀錄：{u1.mention} × {u2.mention} | {record.duration//60} 分鐘 | 延長 {record.extended_times} 次"
+                header += f" | 出席 {record.attended_seconds(record.user1_id) / 60:.0f} / {record.attended_seconds(record.user2_id) / 60:.0f} 分鐘"
+                if session.abandoned:
+                    header += " | 無人在線，提前結束"
+
+                if session.ratings:
+                    feedback = "\n⭐ 評價回饋："
+                    for r in session.ratings:
+                        from_user = await user_resolver.resolve(int(r['user1']))
+                        to_user = await user_resolver.resolve(int(r['user2']))
+                        feedback += f"\n- 「{from_user.mention} → {to_user.mention}」：{r['rating']} ⭐"
+                        if r['comment']:
+                            feedback += f"\n  💬 {r['comment']}"
+                    await admin_reporter.send(f"{header}{feedback}")
+                else:
+                    await admin_reporter.send(f"{header}\n⭐ 沒有收到任何評價。")
+            except Exception as e:
+                print(f"推送管理區評價失敗：{e}")
+    except asyncio.CancelledError:
+        # 關機時保留日誌內容，重啟後續接
+        sessions.remove(session)
+        raise
+    except Exception as e:
+        print(f"❌ 倒數錯誤: {e}")
+    sessions.remove(session)
+    journal.record("finish", session.job_id)
+
+async def start_session(job: dict):
+    """到了排程時間：準備頻道、建立記錄並開始倒數"""
+    with tracer.span("session.start"):
+        job_id = job["job_id"]
+        guild = bot.get_guild(job["guild_id"])
+        if guild is None:
+            # 不是本行程連線的伺服器：不取消，留給負責的行程處理
+            print(f"⚠️ 排程 {job_id} 的伺服器不在本行程，略過")
+            return
+        owner = guild.get_member(job["owner_id"])
+        mentioned = [m for m in (guild.get_member(i) for i in job["member_ids"]) if m]
+        if owner is None or not mentioned:
+            print(f"❌ 無法開始排程 {job_id}：找不到成員")
+            journal.record("cancel", job_id)
+            return
+
+        animal = job["animal"]
+        animal_channel_name = f"{animal}頻道"
+        minutes = job["minutes"]
+
+        overwrites = {
+            guild.default_role: discord.PermissionOverwrite(view_channel=False),
+            owner: discord.PermissionOverwrite(view_channel=True, connect=True),
+        }
+        for m in mentioned:
+            overwrites[m] = discord.PermissionOverwrite(view_channel=True, connect=True)
+
+        try:
+            # 優先從預建頻道池取用，池子空了才即時建立
+            with tracer.span("channel.claim"):
+                pair = await channel_pool_for(guild.id).claim(guild, animal_channel_name, overwrites, job["limit"])
+            if pair:
+                vc, text_channel = pair
+            else:
+                with tracer.span("channel.create"):
+                    category = discord.utils.get(guild.categories, name=SESSION_CATEGORY_NAME)
+                    vc = await guild.create_voice_channel(name=animal_channel_name, overwrites=overwrites, user_limit=job["limit"], category=category)
+                    text_channel = await guild.create_text_channel(name=SESSION_TEXT_CHANNEL_NAME, overwrites=overwrites, category=category)
+        except discord.HTTPException as e:
+            print(f"❌ 建立配對頻道失敗 ({job_id}): {e}")
+            journal.record("cancel", job_id)
+            return
+        session_start_lag.observe(max(0.0, time.time() - job["start_ts"]))
+
+        # 創建本地記錄
+        record = DiscordPairingRecord(
+            user1_id=str(owner.id),
             user2_id=str(mentioned[0].id),
-            duration_minutes=minutes,
+            duration=minutes * 60,
             animal_name=animal
         )
 
-        if peiplay_booking and peiplay_booking.get('success'):
-            record.peiplay_booking_id = peiplay_booking.get('id')
+        # 嘗試創建 PeiPlay booking
+        with tracer.span("booking"):
+            peiplay_booking = await peiplay_api.create_discord_booking(
+                record_id=record.id,
+                user1_id=str(owner.id),
+                user2_id=str(mentioned[0].id),
+                duration_minutes=minutes,
+                animal_name=animal
+            )
+
+        if peiplay_booking and peiplay_booking.get('success'):
+            record.peiplay_booking_id = peiplay_booking.get('id')
+
+        session = PairingSession(
+            vc, text_channel, record,
+            participant_ids=[str(owner.id)] + [str(m.id) for m in mentioned],
+            duration=minutes * 60,
+            job_id=job_id
+        )
+        sessions.add(session)
+        shared_state.register_channel(vc.id, guild.id)
+        journal.record("start", job_id, phase="running", vc_id=vc.id, text_channel_id=text_channel.id,
+                       participant_ids=list(session.participant_ids), record=record.to_dict())
+
+    await countdown(session, [owner] + mentioned)
+
+def schedule_start(job: dict):
+    """把排程交給共用的截止時間排程器，不再為每個排程各開一個 sleep task"""
+    channel_pool_for(job["guild_id"]).expect(job["start_ts"])
+    session_scheduler.schedule(("start", job["job_id"]), "start", loop_time_at(job["start_ts"]),
+                               lambda: start_session(job))
+
+def resume_jobs():
+    """依日誌恢復排程與進行中的場次，只讀取快取，不發出 REST 請求"""
+    resumed = 0
+    now = time.time()
+    for job in list(journal.jobs.values()):
+        job_id, phase = job["job_id"], job["phase"]
+        guild = bot.get_guild(job["guild_id"])
+        if guild is None:
+            # 其他行程負責的伺服器（共用日誌時），不取消
+            continue
+        if phase == "scheduled":
+            if now - job["start_ts"] > JOURNAL_STALE_SECONDS:
+                print(f"⚠️ 排程 {job_id} 已錯過開始時間 {(now - job['start_ts']) / 60:.0f} 分鐘，取消")
+                journal.record("cancel", job_id)
+                continue
+            schedule_start(job)
+            resumed += 1
+            continue
+
+        text_channel = guild.get_channel(job["text_channel_id"])
+        vc = guild.get_channel(job["vc_id"])
+        if text_channel is None or (phase == "running" and vc is None):
+            print(f"⚠️ 場次 {job_id} 的頻道已不存在，略過")
+            journal.record("cancel", job_id)
+            continue
+
+        session = PairingSession(
+            vc or discord.Object(id=job["vc_id"]), text_channel, DiscordPairingRecord.from_dict(job["record"]),
+            participant_ids=job["participant_ids"],
+            duration=job["minutes"] * 60,
+            job_id=job_id
+        )
+        session.extended = job.get("extended", 0)
+        sessions.add(session)
+
+        if phase == "running":
+            shared_state.register_channel(vc.id, guild.id)
+            reconcile_attendance(session, vc)
+            if job.get("message_id"):
+                bot.add_view(ExtendView(vc.id), message_id=job["message_id"])
+            members = [m for m in (guild.get_member(int(i)) for i in job["participant_ids"]) if m]
+            bot.loop.create_task(countdown(session, members, end_ts=job.get("end_ts")))
+        else:
+            sessions.mark_ended(session)
+            bot.loop.create_task(countdown(session, rating_end_ts=job["rating_end_ts"]))
+        resumed += 1
+    if resumed:
+        print(f"🔁 已恢復 {resumed} 筆排程 / 場次")
+
+# --- 語音狀態與出席 ---
+def track_attendance(session: PairingSession, user_id: int, now: float, joined: bool):
+    """記錄參與者進出語音頻道；所有人都離開時開始寬限期倒數"""
+    user_id = str(user_id)
+    if session.ended_at is not None or user_id not in session.participant_ids:
+        return
+    record = session.record
+    if joined:
+        record.join(user_id, now)
+        session_scheduler.cancel(session.vc_id, "empty")
+    else:
+        record.leave(user_id, now)
+        if not record.present():
+            arm_empty_timer(session, EMPTY_SESSION_GRACE_SECONDS)
+    if session.job_id:
+        journal.record("attendance", session.job_id, record=record.to_dict())
+
+def arm_empty_timer(session: PairingSession, grace: float):
+    """語音頻道沒有參與者時，寬限期過後提前結束語音階段"""
+    vc_id = session.vc_id
+
+    def on_empty():
+        if session_scheduler.reschedule(vc_id, "end", asyncio.get_running_loop().time()):
+            session.abandoned = True
+            print(f"👋 {session.record.animal_name}頻道 已無人在線，提前結束")
+
+    session_scheduler.schedule(vc_id, "empty", asyncio.get_running_loop().time() + grace, on_empty)
+
+def reconcile_attendance(session: PairingSession, vc):
+    """重啟後以目前的語音狀態補齊停機期間的進出"""
+    now = time.time()
+    inside = {str(m.id) for m in vc.members} & set(session.participant_ids)
+    for user_id in session.record.present():
+        if user_id not in inside:
+            session.record.leave(user_id, now)
+    for user_id in inside:
+        session.record.join(user_id, now)
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    if before.channel == after.channel:
+        return
+    now = time.time()
+    if before.channel is not None:
+        session = sessions.get_by_vc(before.channel.id)
+        if session:
+            track_attendance(session, member.id, now, joined=False)
+    if after.channel is not None:
+        session = sessions.get_by_vc(after.channel.id)
+        if session:
+            track_attendance(session, member.id, now, joined=True)
+
+# --- 自動配對佇列 ---
+MATCH_MINUTES = (30, 60, 90, 120)
+MATCH_TIERS = (5, 4, 3, 2, 1)
+MATCH_DEFAULT_TIER = 3          # 尚未收到評價的人
+
+matchmaking_wait = metrics.histogram("peiplay_matchmaking_wait_seconds", "從加入佇列到配對成功的時間", ["role"],
+                                     buckets=(1, 5, 15, 30, 60, 120, 300, 600))
+matchmaking_latency = metrics.histogram("peiplay_matchmaking_match_seconds", "每次加入佇列的配對計算時間", [],
+                                        buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+matchmaking_results = metrics.counter("peiplay_matchmaking_results_total", "離開佇列的原因", ["result"])
+
+class QueueEntry:
+    __slots__ = ("user_id", "guild_id", "role", "minutes", "tier", "enqueued_at", "interaction", "active")
+
+    def __init__(self, user_id: int, guild_id: int, role: str, minutes: int, tier: int, interaction=None):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.role = role
+        self.minutes = minutes          # 玩家：想玩的長度；陪玩：最多可陪的長度
+        self.tier = tier
+        self.enqueued_at = time.monotonic()
+        self.interaction = interaction  # 用 followup 通知配對結果
+        self.active = True
+
+class Matchmaker:
+    """/queue 的配對佇列（玩家 × 陪玩）
+
+    每個伺服器依 (角色, 評分等級, 分鐘數) 分成固定數量的 FIFO 桶，桶首就是該桶等最久的人。
+    新加入者只比較相容桶的桶首：分數 = 對方評分等級 + 等待分鐘數 × MATCH_WAIT_WEIGHT，
+    計算量與佇列長度無關。離開與逾時只做標記，輪到桶首時才移除。
+    """
+
+    PLAYER, PARTNER = "player", "partner"
+
+    def __init__(self, scheduler: DeadlineScheduler, timeout: float = MATCH_QUEUE_TIMEOUT,
+                 wait_weight: float = MATCH_WAIT_WEIGHT):
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.wait_weight = wait_weight
+        self._buckets = {}      # (guild_id, role, tier, minutes) -> deque[QueueEntry]
+        self._by_user = {}      # user_id -> QueueEntry
+        self.depth = {self.PLAYER: 0, self.PARTNER: 0}
 
-        active_voice_channels[vc.id] = {
-            'text_channel': text_channel,
-            'remaining': minutes * 60,
-            'extended': 0,
-            'record_id': record.id,
-            'record': record,
-            'vc': vc
-        }
+    def __len__(self):
+        return len(self._by_user)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_user
+
+    @staticmethod
+    def tier_for(user_id: int):
+        avg_rating = pairing_history.user_stats(str(user_id))["avg_rating"]
+        return MATCH_DEFAULT_TIER if avg_rating is None else min(5, max(1, round(avg_rating)))
+
+    def _candidates(self, entry: QueueEntry):
+        """與 entry 相容的對方桶：陪玩可陪的長度必須涵蓋玩家想玩的長度"""
+        if entry.role == self.PLAYER:
+            role, minutes = self.PARTNER, [m for m in MATCH_MINUTES if m >= entry.minutes]
+        else:
+            role, minutes = self.PLAYER, [m for m in MATCH_MINUTES if m <= entry.minutes]
+        for tier in MATCH_TIERS:
+            for m in minutes:
+                key = (entry.guild_id, role, tier, m)
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    continue
+                while bucket and not bucket[0].active:
+                    bucket.popleft()
+                if not bucket:
+                    del self._buckets[key]
+                    continue
+                yield bucket[0]
+
+    def _best(self, entry: QueueEntry):
+        now = time.monotonic()
+        best, best_score = None, None
+        for head in self._candidates(entry):
+            score = head.tier + self.wait_weight * (now - head.enqueued_at) / 60
+            if best is None or score > best_score or (score == best_score and head.enqueued_at < best.enqueued_at):
+                best, best_score = head, score
+        return best
+
+    def enqueue(self, entry: QueueEntry):
+        """加入佇列；有相容的對象時直接配對並回傳對方，否則排隊並回傳 None"""
+        started = time.perf_counter()
+        match = self._best(entry)
+        if match is not None:
+            self.remove(match.user_id)
+        else:
+            self._buckets.setdefault((entry.guild_id, entry.role, entry.tier, entry.minutes), deque()).append(entry)
+            self._by_user[entry.user_id] = entry
+            self.depth[entry.role] += 1
+            self.scheduler.schedule(("queue", entry.user_id), "expire",
+                                    asyncio.get_running_loop().time() + self.timeout, lambda: self._expire(entry))
+        matchmaking_latency.observe(time.perf_counter() - started)
+        return match
+
+    def remove(self, user_id: int):
+        entry = self._by_user.pop(user_id, None)
+        if entry is None:
+            return None
+        entry.active = False
+        self.depth[entry.role] -= 1
+        self.scheduler.cancel(("queue", user_id))
+        return entry
+
+    async def _expire(self, entry: QueueEntry):
+        if self._by_user.get(entry.user_id) is not entry:
+            return
+        self.remove(entry.user_id)
+        matchmaking_results.inc("expired")
+        if entry.interaction:
+            with contextlib.suppress(discord.HTTPException):
+                await entry.interaction.followup.send("⌛ 排隊逾時，目前沒有合適的對象，請稍後再試。", ephemeral=True)
+
+    def stats(self):
+        return {"players": self.depth[self.PLAYER], "partners": self.depth[self.PARTNER]}
+
+matchmaker = Matchmaker(session_scheduler)
+
+async def start_match(entry: QueueEntry, match: QueueEntry):
+    """配對成功：沿用 /createvc 的排程流程開場，並通知雙方"""
+    now = time.monotonic()
+    for e in (entry, match):
+        matchmaking_wait.observe(now - e.enqueued_at, e.role)
+    matchmaking_results.inc("matched")
+    player, partner = (entry, match) if entry.role == Matchmaker.PLAYER else (match, entry)
+
+    animal = random.choice(ANIMALS)
+    job = {
+        "job_id": secrets.token_hex(8),
+        "guild_id": player.guild_id,
+        "owner_id": player.user_id,
+        "member_ids": [partner.user_id],
+        "minutes": player.minutes,
+        "limit": 2,
+        "animal": animal,
+        "start_ts": time.time() + MATCH_START_DELAY,
+    }
+    journal.record("schedule", **job)
+    schedule_start(job)
+
+    text = f"✅ 配對成功！{animal}頻道（{player.minutes} 分鐘）將於 <t:{int(job['start_ts'])}:R> 開啟"
+    for e in (entry, match):
+        if e.interaction is None:
+            continue
+        try:
+            if e.interaction.response.is_done():
+                await e.interaction.followup.send(text, ephemeral=True)
+            else:
+                await e.interaction.response.send_message(text, ephemeral=True)
+        except discord.HTTPException as ex:
+            print(f"⚠️ 通知配對結果失敗 ({e.user_id}): {ex}")
+
+# --- 指令：/createvc ---
+@bot.tree.command(name="createvc", description="建立匿名語音頻道（指定開始時間）", guilds=COMMAND_GUILDS)
+@app_commands.describe(members="標註的成員們", minutes="存在時間（分鐘）", start_time="幾點幾分後啟動 (格式: HH:MM, 24hr)", limit="人數上限")
+@traced("/createvc")
+async def createvc(interaction: discord.Interaction, members: str, minutes: int, start_time: str, limit: int = 2):
+    with tracer.span("defer"):
+        await interaction.response.defer()
+    try:
+        hour, minute = map(int, start_time.split(":"))
+        now = datetime.now(TW_TZ)
+        start_dt = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if start_dt < now:
+            start_dt += timedelta(days=1)
+        start_dt_utc = start_dt.astimezone(timezone.utc)
+    except:
+        await interaction.followup.send("❗ 時間格式錯誤，請使用 HH:MM 24 小時制。")
+        return
+
+    # 解析成員名稱（假設格式是 "name1,name2" 或 "name1 name2"）
+    member_names = [name.strip() for name in members.replace(',', ' ').split() if name.strip()]
+
+    # 使用新的搜尋函數
+    mentioned = []
+    with tracer.span("lookup"):
+        for name in member_names:
+            member = find_member_by_name(interaction.guild, name)
+            if member:
+                mentioned.append(member)
+            else:
+                suggestions = member_index.suggest(interaction.guild, name)
+                hint = f"，你是不是要找：{'、'.join(suggestions)}？" if suggestions else ""
+                await interaction.followup.send(f"❗ 找不到唯一符合的成員：{name}{hint}")
+                return
+
+    if not mentioned:
+        await interaction.followup.send("❗ 請提供至少一位有效的成員名稱。")
+        return
+
+    animal = random.choice(ANIMALS)
+    animal_channel_name = f"{animal}頻道"
+    with tracer.span("followup"):
+        await interaction.followup.send(f"✅ 已排程配對頻道：{animal_channel_name} 將於 <t:{int(start_dt_utc.timestamp())}:t> 開啟")
+
+    job = {
+        "job_id": secrets.token_hex(8),
+        "guild_id": interaction.guild.id,
+        "owner_id": interaction.user.id,
+        "member_ids": [m.id for m in mentioned],
+        "minutes": minutes,
+        "limit": limit,
+        "animal": animal,
+        "start_ts": start_dt_utc.timestamp(),
+    }
+    with tracer.span("schedule"):
+        journal.record("schedule", **job)
+        schedule_start(job)
+
+# --- 指令：/queue ---
+@bot.tree.command(name="queue", description="加入自動配對佇列", guilds=COMMAND_GUILDS)
+@app_commands.describe(role="你的身分", minutes="想玩（或最多可陪玩）的分鐘數")
+@app_commands.choices(
+    role=[app_commands.Choice(name="玩家", value=Matchmaker.PLAYER),
+          app_commands.Choice(name="陪玩", value=Matchmaker.PARTNER)],
+    minutes=[app_commands.Choice(name=f"{m} 分鐘", value=m) for m in MATCH_MINUTES],
+)
+@traced("/queue")
+async def queue(interaction: discord.Interaction, role: app_commands.Choice[str], minutes: app_commands.Choice[int]):
+    user_id = interaction.user.id
+    if user_id in matchmaker:
+        await interaction.response.send_message("❗ 你已經在配對佇列中，可用 /leavequeue 離開。", ephemeral=True)
+        return
+    if any(s.ended_at is None for s in sessions.sessions_for_user(str(user_id))):
+        await interaction.response.send_message("❗ 你目前有進行中的配對。", ephemeral=True)
+        return
+    # 剛配對成功（等待開場中）或有 /createvc 排程的人不能再排隊，避免重複預約
+    if any(job["phase"] == "scheduled" and (job["owner_id"] == user_id or user_id in job["member_ids"])
+           for job in journal.jobs.values()):
+        await interaction.response.send_message("❗ 你已有尚未開始的配對。", ephemeral=True)
+        return
 
-        await countdown(vc.id, animal_channel_name, text_channel, vc, interaction, mentioned, record)
+    entry = QueueEntry(user_id, interaction.guild.id, role.value, minutes.value,
+                       Matchmaker.tier_for(user_id), interaction)
+    match = matchmaker.enqueue(entry)
+    if match is None:
+        await interaction.response.send_message(
+            f"🕒 已加入配對佇列（{role.name}，{minutes.name}），配對成功時會通知你。", ephemeral=True)
+        return
+    await start_match(entry, match)
 
-    bot.loop.create_task(countdown_wrapper())
+@bot.tree.command(name="leavequeue", description="離開自動配對佇列", guilds=COMMAND_GUILDS)
+@traced("/leavequeue")
+async def leavequeue(interaction: discord.Interaction):
+    if matchmaker.remove(interaction.user.id) is None:
+        await interaction.response.send_message("❗ 你不在配對佇列中。", ephemeral=True)
+        return
+    matchmaking_results.inc("left")
+    await interaction.response.send_message("👋 已離開配對佇列。", ephemeral=True)
 
 # --- 其他 Slash 指令 ---
-@bot.tree.command(name="mystats", description="查詢自己的配對統計", guild=discord.Object(id=GUILD_ID))
+@bot.tree.command(name="mystats", description="查詢自己的配對統計", guilds=COMMAND_GUILDS)
+@traced("/mystats")
 async def mystats(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     
-    # 從本地記錄統計
-    records = [r for r in active_voice_channels.values() if r.get('record') and 
-               (r['record'].user1_id == user_id or r['record'].user2_id == user_id)]
-    
-    count = len(records)
-    ratings = [r['record'].rating for r in records if r['record'].rating]
-    comments = [r['record'].comment for r in records if r['record'].comment]
-    avg_rating = round(sum(ratings)/len(ratings), 1) if ratings else "無"
+    # 從累計統計讀取（涵蓋所有歷史配對）
+    user_stats = pairing_history.user_stats(user_id)
+    avg_rating = user_stats["avg_rating"] if user_stats["avg_rating"] is not None else "無"
     
     await interaction.response.send_message(
-        f"📊 你的配對紀錄：\n- 配對次數：{count} 次\n- 平均評分：{avg_rating} ⭐\n- 收到留言：{len(comments)} 則", 
+        f"📊 你的配對紀錄：\n- 配對次數：{user_stats['count']} 次\n- 平均評分：{avg_rating} ⭐\n- 收到留言：{user_stats['comment_count']} 則", 
         ephemeral=True
     )
 
-@bot.tree.command(name="stats", description="查詢他人配對統計 (限管理員)", guild=discord.Object(id=GUILD_ID))
+@bot.tree.command(name="stats", description="查詢他人配對統計 (限管理員)", guilds=COMMAND_GUILDS)
 @app_commands.describe(member="要查詢的使用者")
+@traced("/stats")
 async def stats(interaction: discord.Interaction, member: discord.Member):
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("❌ 僅限管理員查詢。", ephemeral=True)
         return
     
-    user_id = str(member.id)
-    records = [r for r in active_voice_channels.values() if r.get('record') and 
-               (r['record'].user1_id == user_id or r['record'].user2_id == user_id)]
-    
-    count = len(records)
-    ratings = [r['record'].rating for r in records if r['record'].rating]
-    comments = [r['record'].comment for r in records if r['record'].comment]
-    avg_rating = round(sum(ratings)/len(ratings), 1) if ratings else "無"
+    user_stats = pairing_history.user_stats(str(member.id))
+    avg_rating = user_stats["avg_rating"] if user_stats["avg_rating"] is not None else "無"
     
     await interaction.response.send_message(
-        f"📊 <@{member.id}> 的配對紀錄：\n- 配對次數：{count} 次\n- 平均評分：{avg_rating} ⭐\n- 收到留言：{len(comments)} 則", 
+        f"📊 <@{member.id}> 的配對紀錄：\n- 配對次數：{user_stats['count']} 次\n- 平均評分：{avg_rating} ⭐\n- 收到留言：{user_stats['comment_count']} 則", 
         ephemeral=True
     )
 
-@bot.tree.command(name="report", description="舉報不當行為", guild=discord.Object(id=GUILD_ID))
+@bot.tree.command(name="report", description="舉報不當行為", guilds=COMMAND_GUILDS)
 @app_commands.describe(member="被舉報的使用者", reason="舉報原因")
+@traced("/report")
 async def report(interaction: discord.Interaction, member: discord.Member, reason: str):
-    admin = bot.get_channel(ADMIN_CHANNEL_ID)
+    admin = admin_channel()
     await interaction.response.send_message("✅ 舉報已提交，感謝你的協助。", ephemeral=True)
     if admin:
-        await admin.send(f"🚨 舉報通知：<@{interaction.user.id}> 舉報 <@{member.id}>\n📄 理由：{reason}")
+        message_queue.post(admin, f"🚨 舉報通知：<@{interaction.user.id}> 舉報 <@{member.id}>\n📄 理由：{reason}",
+                           priority=MessageQueue.LOW)
 
-@bot.tree.command(name="peiplay_status", description="檢查 PeiPlay 連接狀態", guild=discord.Object(id=GUILD_ID))
+@bot.tree.command(name="peiplay_status", description="檢查 PeiPlay 連接狀態", guilds=COMMAND_GUILDS)
+@traced("/peiplay_status")
 async def peiplay_status(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
     try:
-        response = requests.get(f"{PEIPLAY_API_URL}/api/user/profile", timeout=5)
-        if response.status_code == 200:
-            await interaction.response.send_message("✅ PeiPlay API 連接正常", ephemeral=True)
+        with tracer.span("ping"):
+            status = await peiplay_api.ping()
+        if status == 200:
+            await interaction.followup.send("✅ PeiPlay API 連接正常", ephemeral=True)
         else:
-            await interaction.response.send_message(f"⚠️ PeiPlay API 回應異常：{response.status_code}", ephemeral=True)
+            await interaction.followup.send(f"⚠️ PeiPlay API 回應異常：{status}", ephemeral=True)
+    except Exception as e:
+        await interaction.followup.send(f"❌ PeiPlay API 連接失敗：{e}", ephemeral=True)
+
+@bot.tree.command(name="slow_traces", description="顯示最慢的指令追蹤與事件迴圈卡頓 (限管理員)", guilds=COMMAND_GUILDS)
+@app_commands.describe(count="顯示幾筆")
+async def slow_traces(interaction: discord.Interaction, count: int = 5):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ 僅限管理員查詢。", ephemeral=True)
+        return
+
+    lines = []
+    if not tracer.enabled:
+        lines.append("（追蹤未啟用，設定 TRACE_ENABLED=1 後重啟）")
+    for span in tracer.slowest(max(1, min(count, 20))):
+        lines.extend(span.format())
+        lines.append("")
+    if loop_watchdog.stalls:
+        at, stalled, stack = loop_watchdog.stalls[-1]
+        lines.append(f"最近一次迴圈卡頓：{at:%m/%d %H:%M:%S}，{stalled:.2f} 秒（共 {len(loop_watchdog.stalls)} 筆）")
+        lines.extend(stack.strip().splitlines()[-6:])
+    body = "\n".join(lines).strip() or "目前沒有追蹤資料。"
+    await interaction.response.send_message(f"```\n{body[:1900]}\n```", ephemeral=True)
+
+@bot.tree.command(name="export_pairings", description="匯出配對紀錄與評價 (限管理員)", guilds=COMMAND_GUILDS)
+@app_commands.describe(start="開始日期 (YYYY-MM-DD)", end="結束日期 (YYYY-MM-DD，含當天)", member="只匯出此使用者的配對",
+                       fmt="檔案格式")
+@app_commands.choices(fmt=[app_commands.Choice(name="CSV", value="csv"), app_commands.Choice(name="Excel (XLSX)", value="xlsx")])
+@traced("/export_pairings")
+async def export_pairings(interaction: discord.Interaction, start: str, end: str, member: discord.Member = None,
+                          fmt: app_commands.Choice[str] = None):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("❌ 僅限管理員匯出。", ephemeral=True)
+        return
+    try:
+        start_iso, end_iso = PairingExport.parse_range(start, end)
+    except ValueError as e:
+        await interaction.response.send_message(f"❗ {e}", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    fmt = fmt.value if fmt else "csv"
+    user_id = str(member.id) if member else None
+    try:
+        with tracer.span("export"):
+            path = await asyncio.to_thread(pairing_export.write_file, fmt, start_iso, end_iso, user_id)
+    except ImportError:
+        await interaction.followup.send("❌ 未安裝 openpyxl，請改用 CSV 格式。", ephemeral=True)
+        return
     except Exception as e:
-        await interaction.response.send_message(f"❌ PeiPlay API 連接失敗：{e}", ephemeral=True)
+        await interaction.followup.send(f"❌ 匯出失敗：{e}", ephemeral=True)
+        return
+    try:
+        if os.path.getsize(path) > interaction.guild.filesize_limit:
+            await interaction.followup.send("❗ 檔案超過 Discord 上傳上限，請縮小日期範圍或改用 Control API 的 /export/pairings。",
+                                            ephemeral=True)
+            return
+        await interaction.followup.send(f"📄 配對紀錄 {start} ~ {end}",
+                                        file=discord.File(path, filename=PairingExport.filename(fmt, start, end)),
+                                        ephemeral=True)
+    finally:
+        os.unlink(path)
+
+# --- Discord 請求排程 ---
+class TokenBucket:
+    """以預約方式取用的 token bucket：回傳需要等待的秒數"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self, now: float):
+        """已回滿且未暫停：丟掉後重新建立的 bucket 行為完全相同"""
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class RateLimitScheduler:
+    """依 Discord 全域與各 route 的速率限制排程請求
+
+    請求先向全域與 route bucket 預約 token，並在並行上限內同時執行；
+    遇到 429 時依伺服器提供的 retry_after 暫停該 route 後重試。
+    每個頻道 / 成員都有自己的 route，新增 route 時會順便清掉已閒置的 bucket，
+    讓 map 的大小跟著「近期有在用的 route」走，而不是隨執行時間成長。
+    """
+
+    SWEEP_MIN = 64
+
+    def __init__(self, global_bucket: TokenBucket, max_concurrency: int = DISCORD_MOVE_CONCURRENCY):
+        self._global = global_bucket
+        self._routes = {}
+        self._active = {}      # route -> 進行中（含等待並行額度）的請求數
+        self._sweep_at = self.SWEEP_MIN
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.rate_limited_total = 0
+
+    def __len__(self):
+        return len(self._routes)
+
+    def _bucket(self, route: str, rate: float, burst: int):
+        bucket = self._routes.get(route)
+        if bucket is None:
+            if len(self._routes) >= self._sweep_at:
+                self._sweep()
+            bucket = self._routes[route] = TokenBucket(rate, burst)
+        return bucket
+
+    def _sweep(self):
+        # 與 DeadlineScheduler._compact 相同的攤銷方式：map 翻倍時才掃一次
+        now = time.monotonic()
+        for route in [route for route, bucket in self._routes.items()
+                      if route not in self._active and bucket.idle(now)]:
+            del self._routes[route]
+        self._sweep_at = max(self.SWEEP_MIN, 2 * len(self._routes))
+
+    async def run(self, route: str, factory, rate: float, burst: int, max_retries: int = 3):
+        """在速率限制內執行 factory() 產生的 coroutine"""
+        bucket = self._bucket(route, rate, burst)
+        self._active[route] = self._active.get(route, 0) + 1
+        try:
+            return await self._run(bucket, factory, max_retries)
+        finally:
+            self._active[route] -= 1
+            if not self._active[route]:
+                del self._active[route]
+
+    async def _run(self, bucket: TokenBucket, factory, max_retries: int):
+        async with self._semaphore:
+            for attempt in range(max_retries + 1):
+                now = time.monotonic()
+                wait = max(self._global.reserve(now), bucket.reserve(now))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    return await factory()
+                except discord.RateLimited as e:
+                    retry_after = e.retry_after
+                except discord.HTTPException as e:
+                    if e.status != 429 or attempt == max_retries:
+                        raise
+                    retry_after = float(e.response.headers.get("Retry-After", 1)) if e.response is not None else 1.0
+                self.rate_limited_total += 1
+                bucket.pause(retry_after)
+            raise discord.RateLimited(retry_after)
+
+# 全域速率限制由所有排程器共用；移動與訊息各自有並行上限，互不佔用
+discord_global_bucket = TokenBucket(DISCORD_GLOBAL_RATE, DISCORD_GLOBAL_RATE)
+discord_scheduler = RateLimitScheduler(discord_global_bucket)
+message_scheduler = RateLimitScheduler(discord_global_bucket, MESSAGE_SEND_CONCURRENCY)
+
+# --- 訊息發送佇列 ---
+message_send_latency = metrics.histogram("peiplay_message_send_seconds", "訊息從排入佇列到送出的時間", ["channel"],
+                                         buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+messages_coalesced = metrics.counter("peiplay_messages_coalesced_total", "合併進其他訊息、省下的發送次數", ["channel"])
+
+class QueuedMessage:
+    __slots__ = ("priority", "seq", "content", "view", "future", "queued_at")
+
+    def __init__(self, priority: int, seq: int, content, view, future):
+        self.priority = priority
+        self.seq = seq
+        self.content = content
+        self.view = view
+        self.future = future
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class MessageQueue:
+    """每個頻道一條的訊息發送佇列
+
+    短時間內排入同一頻道的訊息會合併成一則（最多 2000 字、一個 View），
+    依優先度送出：緊急訊息（剩餘 1 分鐘提醒）不等待合併，直接插到最前面。
+    發送經過 message_scheduler，遇到 429 會依伺服器提供的 retry_after 重試。
+    """
+
+    URGENT, NORMAL, LOW = 0, 1, 2
+    MAX_MESSAGE_LENGTH = 2000
+
+    def __init__(self, window: float = MESSAGE_COALESCE_WINDOW, rate: float = MESSAGE_RATE, burst: int = MESSAGE_BURST):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self._queues = {}       # channel_id -> [QueuedMessage]（heap）
+        self._urgent = {}       # channel_id -> asyncio.Event
+        self._tasks = {}        # channel_id -> 發送 Task
+        self._latency = {}      # 頻道名稱 -> deque(最近的延遲)
+        self._seq = itertools.count()
+        self._sending = 0
+
+    @property
+    def pending(self):
+        """尚未送出的訊息數（含發送中）"""
+        return sum(len(queue) for queue in self._queues.values()) + self._sending
+
+    def _enqueue(self, channel, content, view, priority, future):
+        queue = self._queues.setdefault(channel.id, [])
+        heapq.heappush(queue, QueuedMessage(priority, next(self._seq), content, view, future))
+        urgent = self._urgent.setdefault(channel.id, asyncio.Event())
+        if priority == self.URGENT:
+            urgent.set()
+        if channel.id not in self._tasks:
+            self._tasks[channel.id] = asyncio.get_running_loop().create_task(self._drain(channel))
+
+    def post(self, channel, content: str = None, *, view=None, priority: int = NORMAL):
+        """排入訊息，不等待結果（失敗只記錄）"""
+        self._enqueue(channel, content, view, priority, None)
+
+    async def send(self, channel, content: str = None, *, view=None, priority: int = NORMAL):
+        """排入訊息並等待送出，回傳實際送出的（可能是合併後的）訊息"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(channel, content, view, priority, future)
+        return await future
+
+    def _take_batch(self, queue):
+        batch, length, view = [], 0, None
+        while queue:
+            item = queue[0]
+            extra = len(item.content or "") + (1 if batch and item.content else 0)
+            if batch and (length + extra > self.MAX_MESSAGE_LENGTH or (item.view is not None and view is not None)):
+                break
+            heapq.heappop(queue)
+            batch.append(item)
+            length += extra
+            view = view or item.view
+        return batch, view
+
+    async def _drain(self, channel):
+        queue, urgent = self._queues[channel.id], self._urgent[channel.id]
+        try:
+            while queue:
+                if queue[0].priority != self.URGENT and not urgent.is_set():
+                    try:
+                        await asyncio.wait_for(urgent.wait(), self.window)
+                    except asyncio.TimeoutError:
+                        pass
+                urgent.clear()
+                batch, view = self._take_batch(queue)
+                await self._deliver(channel, batch, view)
+        finally:
+            del self._queues[channel.id], self._urgent[channel.id], self._tasks[channel.id]
+
+    async def _deliver(self, channel, batch, view):
+        name = getattr(channel, "name", str(channel.id))
+        content = "\n".join(item.content for item in batch if item.content) or None
+        kwargs = {"content": content, "view": view} if view is not None else {"content": content}
+        self._sending += len(batch)
+        try:
+            message = await message_scheduler.run(f"POST /channels/{channel.id}/messages",
+                                                  lambda: channel.send(**kwargs), self.rate, self.burst)
+        except Exception as e:
+            print(f"❌ 訊息發送失敗（{name}）: {e}")
+            for item in batch:
+                if item.future and not item.future.done():
+                    item.future.set_exception(e)
+            return
+        finally:
+            self._sending -= len(batch)
+        now = time.monotonic()
+        samples = self._latency.setdefault(name, deque(maxlen=1024))
+        for item in batch:
+            message_send_latency.observe(now - item.queued_at, name)
+            samples.append(now - item.queued_at)
+            if item.future and not item.future.done():
+                item.future.set_result(message)
+        if len(batch) > 1:
+            messages_coalesced.inc(name, value=len(batch) - 1)
+
+    def stats(self):
+        """各頻道最近發送延遲的百分位（秒）"""
+        result = {"pending": self.pending, "channels": {}}
+        for name, samples in self._latency.items():
+            ordered = sorted(samples)
+            result["channels"][name] = {
+                f"p{q}": round(ordered[min(len(ordered) - 1, len(ordered) * q // 100)], 3) for q in (50, 95, 99)
+            }
+            result["channels"][name]["count"] = len(ordered)
+        return result
+
+    async def close(self, timeout: float = 5):
+        """關機前盡量送完佇列中的訊息"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+message_queue = MessageQueue()
+
+# --- 預建頻道池 ---
+class ChannelPool:
+    """預先建立、隱藏的語音 / 文字頻道池
+
+    場次開始時直接取用池中頻道（改名 + 套用參與者權限），結束後清除權限與訊息放回池中，
+    省去開場時建立頻道的延遲，也避免整點大量開場時集中消耗建立頻道的速率限制。
+    Discord 限制每個頻道 10 分鐘內最多改名 2 次，因此歸還時不改回原名，
+    取用時也只挑仍有改名額度的語音頻道。
+    池中頻道的 ID 記在本地資料庫，重新啟動時只收回自己建立的頻道。
+    """
+
+    RENAME_LIMIT = 2
+    RENAME_WINDOW = 600
+
+    def __init__(self, conn, size: int = CHANNEL_POOL_SIZE, lookahead: int = CHANNEL_POOL_LOOKAHEAD):
+        self.conn = conn
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS channel_pool (
+                channel_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL
+            )
+        """)
+        self.size = size
+        self.lookahead = lookahead
+        self._voice = deque()
+        self._text = deque()
+        self._renames = {}      # vc_id -> deque(改名時間)
+        self._upcoming = []     # 已排程場次的開始時間（已排序）
+        self._wakeup = None
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.created_total = 0
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def target(self):
+        """池子目標大小：基本數量 + 即將開始的場次數"""
+        now = time.time()
+        del self._upcoming[:bisect.bisect_left(self._upcoming, now)]
+        return self.size + bisect.bisect_right(self._upcoming, now + self.lookahead)
+
+    def expect(self, start_ts: float):
+        if not self.enabled:
+            return
+        bisect.insort(self._upcoming, start_ts)
+        self._wake()
+
+    def stats(self):
+        return {
+            "idle_voice": len(self._voice),
+            "idle_text": len(self._text),
+            "target": self.target() if self.enabled else 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "created_total": self.created_total,
+        }
+
+    def _wake(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    @staticmethod
+    def _hidden_overwrites(guild):
+        return {guild.default_role: discord.PermissionOverwrite(view_channel=False)}
+
+    def _remember(self, channel):
+        self.conn.execute("INSERT OR IGNORE INTO channel_pool (channel_id, guild_id) VALUES (?, ?)",
+                          (channel.id, channel.guild.id))
+
+    def _forget(self, channel):
+        self.conn.execute("DELETE FROM channel_pool WHERE channel_id = ?", (channel.id,))
+
+    async def _delete(self, channel):
+        self._renames.pop(channel.id, None)
+        self._forget(channel)
+        await channel.delete()
+
+    def _can_rename(self, vc_id):
+        history = self._renames.get(vc_id)
+        if not history:
+            return True
+        while history and history[0] < time.monotonic() - self.RENAME_WINDOW:
+            history.popleft()
+        return len(history) < self.RENAME_LIMIT
+
+    def _take_voice(self, guild):
+        for _ in range(len(self._voice)):
+            vc = self._voice.popleft()
+            if guild.get_channel(vc.id) is None:
+                self._renames.pop(vc.id, None)
+                continue
+            if self._can_rename(vc.id):
+                return vc
+            self._voice.append(vc)
+        return None
+
+    def _take_text(self, guild):
+        while self._text:
+            text_channel = self._text.popleft()
+            if guild.get_channel(text_channel.id) is not None:
+                return text_channel
+        return None
+
+    async def claim(self, guild, name: str, overwrites: dict, limit: int):
+        """取用一組頻道；池子不夠時回傳 None，由呼叫端即時建立"""
+        if not self.enabled:
+            return None
+        vc = self._take_voice(guild)
+        text_channel = self._take_text(guild) if vc else None
+        if vc is None or text_channel is None:
+            if vc:
+                self._voice.appendleft(vc)
+            self.misses += 1
+            self._wake()
+            return None
+        try:
+            if vc.name != name:
+                self._renames.setdefault(vc.id, deque()).append(time.monotonic())
+            await asyncio.gather(
+                vc.edit(name=name, overwrites=overwrites, user_limit=limit),
+                text_channel.edit(overwrites=overwrites),
+            )
+        except discord.HTTPException as e:
+            print(f"⚠️ 取用預建頻道失敗，改為即時建立: {e}")
+            self.misses += 1
+            await self._discard(vc, text_channel)
+            return None
+        self.hits += 1
+        self._wake()
+        return vc, text_channel
+
+    async def _discard(self, *channels):
+        for channel in channels:
+            try:
+                await self._delete(channel)
+            except discord.HTTPException:
+                pass
+
+    def _is_full(self, idle):
+        return not self.enabled or len(idle) >= self.target()
+
+    async def release_voice(self, vc):
+        """結束語音：清除權限、斷開成員後放回池中（池子已滿則刪除）"""
+        if self._is_full(self._voice):
+            await self._delete(vc)
+            return
+        try:
+            await vc.edit(overwrites=self._hidden_overwrites(vc.guild))
+            route = f"PATCH /guilds/{vc.guild.id}/members"
+            await asyncio.gather(*(
+                discord_scheduler.run(route, lambda m=member: m.move_to(None), DISCORD_MOVE_RATE, DISCORD_MOVE_BURST)
+                for member in vc.members
+            ))
+            await vc.purge(limit=None)
+        except discord.HTTPException as e:
+            print(f"⚠️ 回收語音頻道失敗，改為刪除: {e}")
+            await self._discard(vc)
+            return
+        self._remember(vc)
+        self._voice.append(vc)
+
+    async def release_text(self, text_channel):
+        """結束文字區：清除權限與訊息後放回池中（池子已滿則刪除）"""
+        if self._is_full(self._text):
+            await self._delete(text_channel)
+            return
+        try:
+            await text_channel.edit(overwrites=self._hidden_overwrites(text_channel.guild))
+            await text_channel.purge(limit=None)
+        except discord.HTTPException as e:
+            print(f"⚠️ 回收文字頻道失敗，改為刪除: {e}")
+            await self._discard(text_channel)
+            return
+        self._remember(text_channel)
+        self._text.append(text_channel)
+
+    def _adopt(self, guild, category):
+        """重新啟動後收回分類中閒置的池頻道：必須是池子建立的，且 @everyone 看不到"""
+        owned = {row[0] for row in self.conn.execute(
+            "SELECT channel_id FROM channel_pool WHERE guild_id = ?", (guild.id,))}
+        gone = [(i,) for i in owned if guild.get_channel(i) is None]
+        self.conn.executemany("DELETE FROM channel_pool WHERE channel_id = ?", gone)
+        if category is None:
+            return
+        known = {c.id for c in self._voice} | {c.id for c in self._text}
+        for channel in category.channels:
+            if channel.id not in owned or channel.id in known:
+                continue
+            if sessions.get_by_vc(channel.id) or sessions.get_by_text(channel.id):
+                continue
+            overwrites = channel.overwrites
+            if set(overwrites) - {guild.default_role, guild.me}:
+                continue
+            everyone = overwrites.get(guild.default_role)
+            if everyone is None or everyone.view_channel is not False:
+                continue
+            if isinstance(channel, discord.VoiceChannel) and not channel.members:
+                self._voice.append(channel)
+            elif isinstance(channel, discord.TextChannel) and channel.name == SESSION_TEXT_CHANNEL_NAME:
+                self._text.append(channel)
+
+    async def _refill(self, guild):
+        category = discord.utils.get(guild.categories, name=SESSION_CATEGORY_NAME)
+        self._adopt(guild, category)
+        while True:
+            self._wakeup.clear()
+            target = self.target()
+            try:
+                while len(self._voice) < target or len(self._text) < target:
+                    route = f"POST /guilds/{guild.id}/channels"
+                    if len(self._voice) < target:
+                        vc = await discord_scheduler.run(route, lambda: guild.create_voice_channel(
+                            name="🔒待命頻道", overwrites=self._hidden_overwrites(guild), category=category), 1, 2)
+                        self._remember(vc)
+                        self._voice.append(vc)
+                        self.created_total += 1
+                    if len(self._text) < target:
+                        text_channel = await discord_scheduler.run(route, lambda: guild.create_text_channel(
+                            name=SESSION_TEXT_CHANNEL_NAME, overwrites=self._hidden_overwrites(guild), category=category), 1, 2)
+                        self._remember(text_channel)
+                        self._text.append(text_channel)
+                        self.created_total += 1
+            except discord.HTTPException as e:
+                print(f"⚠️ 補充預建頻道失敗: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 30)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, guild):
+        if not self.enabled or self._task:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._refill(guild))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+channel_pools = {}      # guild_id -> ChannelPool，各伺服器的頻道池互不共用
+
+def channel_pool_for(guild_id: int) -> ChannelPool:
+    pool = channel_pools.get(guild_id)
+    if pool is None:
+        pool = channel_pools[guild_id] = ChannelPool(local_db)
+    return pool
+
+# --- 多行程共用狀態 ---
+class StateBackend(abc.ABC):
+    """多個 bot 行程共用的狀態：伺服器由哪個行程負責、場次語音頻道屬於哪個伺服器，
+    以及轉交給負責行程執行的控制指令信箱。
+    """
+
+    @abc.abstractmethod
+    def claim_guilds(self, process_id: str, guild_ids, ttl: float):
+        """宣告（或續約）負責這些伺服器；已由其他仍存活的行程負責的伺服器不會被搶走"""
+        ...
+
+    @abc.abstractmethod
+    def release_guilds(self, process_id: str):
+        ...
+
+    @abc.abstractmethod
+    def guild_owner(self, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    def register_channel(self, channel_id: int, guild_id: int):
+        ...
+
+    @abc.abstractmethod
+    def unregister_channel(self, channel_id: int):
+        ...
+
+    @abc.abstractmethod
+    def channel_guild(self, channel_id: int):
+        ...
+
+    @abc.abstractmethod
+    def post(self, process_id: str, command: dict) -> int:
+        """把指令放進負責行程的信箱，回傳指令編號"""
+        ...
+
+    @abc.abstractmethod
+    def take(self, process_id: str, limit: int = 50):
+        """取出自己信箱中尚未處理的指令 [(編號, 指令)]"""
+        ...
+
+    @abc.abstractmethod
+    def complete(self, command_id: int, result: dict):
+        ...
+
+    @abc.abstractmethod
+    def result(self, command_id: int):
+        """取回指令結果（尚未完成時回傳 None）"""
+        ...
+
+class MemoryStateBackend(StateBackend):
+    """單一行程（或同一個直譯器內的測試）使用的記憶體實作"""
+
+    def __init__(self):
+        self._owners = {}       # guild_id -> (process_id, 到期時間)
+        self._channels = {}     # channel_id -> guild_id
+        self._inbox = {}        # process_id -> deque((編號, 指令))
+        self._results = {}      # 編號 -> 結果
+        self._ids = itertools.count(1)
+
+    def claim_guilds(self, process_id, guild_ids, ttl):
+        now = time.time()
+        claimed = []
+        for guild_id in guild_ids:
+            owner = self._owners.get(guild_id)
+            if owner is None or owner[0] == process_id or owner[1] < now:
+                self._owners[guild_id] = (process_id, now + ttl)
+                claimed.append(guild_id)
+        return claimed
+
+    def release_guilds(self, process_id):
+        for guild_id in [g for g, (owner, _) in self._owners.items() if owner == process_id]:
+            del self._owners[guild_id]
+
+    def guild_owner(self, guild_id):
+        owner = self._owners.get(guild_id)
+        return owner[0] if owner and owner[1] >= time.time() else None
+
+    def register_channel(self, channel_id, guild_id):
+        self._channels[channel_id] = guild_id
+
+    def unregister_channel(self, channel_id):
+        self._channels.pop(channel_id, None)
+
+    def channel_guild(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def post(self, process_id, command):
+        command_id = next(self._ids)
+        self._inbox.setdefault(process_id, deque()).append((command_id, command))
+        return command_id
+
+    def take(self, process_id, limit=50):
+        inbox = self._inbox.get(process_id)
+        taken = []
+        while inbox and len(taken) < limit:
+            taken.append(inbox.popleft())
+        return taken
+
+    def complete(self, command_id, result):
+        self._results[command_id] = result
+
+    def result(self, command_id):
+        return self._results.pop(command_id, None)
+
+class SQLiteStateBackend(StateBackend):
+    """同一台主機上多個行程共用的 SQLite 實作（WAL 模式，各行程各自連線）"""
+
+    def __init__(self, conn, retention: float = 600):
+        self.conn = conn
+        self.retention = retention
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS guild_owners (
+                guild_id INTEGER PRIMARY KEY,
+                process_id TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS session_channels (
+                channel_id INTEGER PRIMARY KEY,
+                guild_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS mailbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                process_id TEXT NOT NULL,
+                command TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                result TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_mailbox_inbox ON mailbox(process_id, status, id);
+        """)
+
+    def claim_guilds(self, process_id, guild_ids, ttl):
+        now = time.time()
+        claimed = []
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for guild_id in guild_ids:
+                cursor = self.conn.execute(
+                    "INSERT INTO guild_owners (guild_id, process_id, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(guild_id) DO UPDATE SET process_id = excluded.process_id, expires_at = excluded.expires_at "
+                    "WHERE guild_owners.process_id = excluded.process_id OR guild_owners.expires_at < ?",
+                    (guild_id, process_id, now + ttl, now),
+                )
+                if cursor.rowcount:
+                    claimed.append(guild_id)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return claimed
+
+    def release_guilds(self, process_id):
+        self.conn.execute("DELETE FROM guild_owners WHERE process_id = ?", (process_id,))
 
-# --- Flask API ---
-app = Flask(__name__)
+    def guild_owner(self, guild_id):
+        row = self.conn.execute(
+            "SELECT process_id FROM guild_owners WHERE guild_id = ? AND expires_at >= ?", (guild_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
 
-@app.route("/move_user", methods=["POST"])
-def move_user():
-    data = request.get_json()
-    discord_id = int(data.get("discord_id"))
-    vc_id = int(data.get("vc_id"))
+    def register_channel(self, channel_id, guild_id):
+        self.conn.execute("INSERT OR REPLACE INTO session_channels (channel_id, guild_id) VALUES (?, ?)",
+                          (channel_id, guild_id))
 
-    async def mover():
-        guild = bot.get_guild(GUILD_ID)
-        member = guild.get_member(discord_id)
-        vc = guild.get_channel(vc_id)
-        if member and vc:
-            await member.move_to(vc)
+    def unregister_channel(self, channel_id):
+        self.conn.execute("DELETE FROM session_channels WHERE channel_id = ?", (channel_id,))
 
-    bot.loop.create_task(mover())
-    return jsonify({"status": "ok"})
+    def channel_guild(self, channel_id):
+        row = self.conn.execute("SELECT guild_id FROM session_channels WHERE channel_id = ?", (channel_id,)).fetchone()
+        return row[0] if row else None
+
+    def post(self, process_id, command):
+        cursor = self.conn.execute(
+            "INSERT INTO mailbox (process_id, command, created_at) VALUES (?, ?, ?)",
+            (process_id, json.dumps(command), time.time()),
+        )
+        return cursor.lastrowid
+
+    def take(self, process_id, limit=50):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                "SELECT id, command FROM mailbox WHERE process_id = ? AND status = 'pending' ORDER BY id LIMIT ?",
+                (process_id, limit),
+            ).fetchall()
+            self.conn.executemany("UPDATE mailbox SET status = 'taken' WHERE id = ?", [(row[0],) for row in rows])
+            # 等待端逾時後沒人取回的結果
+            self.conn.execute("DELETE FROM mailbox WHERE created_at < ?", (time.time() - self.retention,))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [(command_id, json.loads(command)) for command_id, command in rows]
+
+    def complete(self, command_id, result):
+        self.conn.execute("UPDATE mailbox SET status = 'done', result = ? WHERE id = ?",
+                          (json.dumps(result), command_id))
+
+    def result(self, command_id):
+        row = self.conn.execute("SELECT result FROM mailbox WHERE id = ? AND status = 'done'", (command_id,)).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("DELETE FROM mailbox WHERE id = ?", (command_id,))
+        return json.loads(row[0])
+
+def open_state_backend(kind: str = STATE_BACKEND):
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "sqlite":
+        return SQLiteStateBackend(open_local_db(STATE_DB_PATH))
+    raise ValueError(f"未知的 STATE_BACKEND：{kind}")
+
+shared_state = open_state_backend()
+mailbox_commands = metrics.counter("peiplay_mailbox_commands_total", "經由指令信箱轉交的控制指令", ["direction", "name"])
+
+class CommandMailbox:
+    """把控制指令交給負責該伺服器的行程執行
+
+    每個行程定期續約自己連線到的伺服器，並輪詢自己的信箱；
+    任何行程收到的 Control API 請求，若目標伺服器由其他行程負責，就放進對方信箱等待結果。
+    """
+
+    def __init__(self, backend: StateBackend, process_id: str = PROCESS_ID,
+                 poll_interval: float = MAILBOX_POLL_INTERVAL, timeout: float = MAILBOX_TIMEOUT,
+                 owner_ttl: float = STATE_OWNER_TTL):
+        self.backend = backend
+        self.process_id = process_id
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.owner_ttl = owner_ttl
+        self.handlers = {}
+        self.owned = set()
+        self._task = None
+
+    def handler(self, name: str):
+        def decorator(func):
+            self.handlers[name] = func
+            return func
+        return decorator
+
+    async def _execute(self, name: str, args: dict):
+        handler = self.handlers.get(name)
+        if handler is None:
+            raise ControlAPIError(400, f"unknown_command_{name}")
+        return await handler(**args)
+
+    async def call(self, guild_id: int, name: str, **args):
+        """在負責 guild_id 的行程上執行指令，回傳結果或丟出 ControlAPIError"""
+        owner = self.backend.guild_owner(guild_id)
+        if owner is None:
+            raise ControlAPIError(503, "guild_unavailable")
+        if owner == self.process_id:
+            return await self._execute(name, args)
+
+        command_id = self.backend.post(owner, {"name": name, "args": args})
+        mailbox_commands.inc("sent", name)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            result = self.backend.result(command_id)
+            if result is not None:
+                if "error" in result:
+                    raise ControlAPIError(result["status"], result["error"])
+                return result
+        raise ControlAPIError(504, "owner_timeout")
+
+    async def _handle(self, command_id: int, command: dict):
+        try:
+            result = await self._execute(command["name"], command["args"])
+        except ControlAPIError as e:
+            result = {"status": e.status, "error": e.error}
+        except Exception as e:
+            print(f"❌ 信箱指令失敗 ({command['name']}): {e}")
+            result = {"status": 500, "error": "internal_error"}
+        mailbox_commands.inc("handled", command["name"])
+        self.backend.complete(command_id, result)
+
+    def _renew(self):
+        claimed = set(self.backend.claim_guilds(self.process_id, [g.id for g in bot.guilds], self.owner_ttl))
+        for guild_id in claimed - self.owned:
+            print(f"✅ 由本行程（{self.process_id}）負責伺服器 {guild_id}")
+        for guild_id in self.owned - claimed:
+            print(f"⚠️ 伺服器 {guild_id} 已由其他行程負責")
+        self.owned = claimed
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        renew_at = 0.0
+        while True:
+            try:
+                if loop.time() >= renew_at:
+                    self._renew()
+                    renew_at = loop.time() + self.owner_ttl / 3
+                for command_id, command in self.backend.take(self.process_id):
+                    loop.create_task(self._handle(command_id, command))
+            except Exception as e:
+                print(f"⚠️ 指令信箱處理失敗: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+            self.backend.release_guilds(self.process_id)
+
+command_mailbox = CommandMailbox(shared_state)
+
+# --- Control API ---
+class ControlAPIError(Exception):
+    """Control API 請求錯誤，轉成對應的 HTTP 狀態碼回傳"""
+
+    def __init__(self, status: int, error: str):
+        super().__init__(error)
+        self.status = status
+        self.error = error
+
+def json_response(data, status: int = 200):
+    from aiohttp import web
+    return web.json_response(data, status=status)
+
+async def read_json_body(request):
+    try:
+        data = await request.json()
+    except Exception:
+        raise ControlAPIError(400, "invalid_json")
+    if not isinstance(data, dict):
+        raise ControlAPIError(400, "invalid_json")
+    return data
+
+def require_int(data: dict, field: str):
+    try:
+        return int(data[field])
+    except KeyError:
+        raise ControlAPIError(400, f"missing_{field}")
+    except (TypeError, ValueError):
+        raise ControlAPIError(400, f"invalid_{field}")
+
+async def move_member(discord_id: int, vc_id: int, guild_id: int = None):
+    """移動成員到語音頻道，回傳實際結果；頻道所在伺服器由其他行程負責時轉交過去"""
+    if bot.get_channel(vc_id) is None:
+        guild_id = guild_id or shared_state.channel_guild(vc_id)
+        if guild_id is None or bot.get_guild(guild_id) is not None:
+            raise ControlAPIError(404, "channel_not_found")
+        return await command_mailbox.call(guild_id, "move", discord_id=discord_id, vc_id=vc_id)
+    return await move_member_local(discord_id, vc_id)
+
+@command_mailbox.handler("move")
+async def move_member_local(discord_id: int, vc_id: int):
+    vc = bot.get_channel(vc_id)
+    if not isinstance(vc, discord.VoiceChannel):
+        raise ControlAPIError(404, "channel_not_found")
+    guild = vc.guild
+    member = guild.get_member(discord_id)
+    if member is None:
+        raise ControlAPIError(404, "member_not_found")
+    if not (member.voice and member.voice.channel):
+        raise ControlAPIError(409, "member_not_in_voice")
+    try:
+        await discord_scheduler.run(f"PATCH /guilds/{guild.id}/members", lambda: member.move_to(vc),
+                                    DISCORD_MOVE_RATE, DISCORD_MOVE_BURST)
+    except discord.Forbidden:
+        raise ControlAPIError(403, "forbidden")
+    except discord.RateLimited:
+        raise ControlAPIError(429, "rate_limited")
+    except discord.HTTPException as e:
+        raise ControlAPIError(502, f"discord_error_{e.status}")
+    return {"status": "moved", "discord_id": str(discord_id), "vc_id": str(vc_id)}
+
+async def move_members(moves):
+    """並行移動多位成員（受速率限制排程），回傳每筆的結果"""
+    async def attempt(discord_id, vc_id, guild_id=None):
+        try:
+            return await move_member(discord_id, vc_id, guild_id)
+        except ControlAPIError as e:
+            return {"status": "error", "error": e.error, "discord_id": str(discord_id), "vc_id": str(vc_id)}
+
+    return await asyncio.gather(*(attempt(*move) for move in moves))
+
+class ControlAPI:
+    """在 bot 事件迴圈內執行的 HTTP 控制介面（aiohttp）
+
+    handler 直接 await Discord 操作並回傳真正的結果；
+    同時處理中的請求數有上限，超過時回 503，不會無限堆積。
+    設定 token 後每個請求都要帶 Authorization: Bearer <token>；
+    標記 require_token 的路由（例如匯出個資）在沒有設定 token 時一律拒絕。
+    aiohttp.web 只在啟用（CONTROL_API_PORT > 0）時才載入。
+    """
+
+    def __init__(self, host: str = CONTROL_API_HOST, port: int = CONTROL_API_PORT,
+                 max_concurrency: int = CONTROL_API_MAX_CONCURRENCY, token: str = CONTROL_API_TOKEN):
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.token = token
+        self.in_flight = 0
+        self.rejected_total = 0
+        self.routes = []    # (method, path, handler)
+        self._token_required = set()
+        self._runner = None
+
+    @property
+    def enabled(self):
+        return self.port > 0
+
+    def route(self, method: str, path: str, require_token: bool = False):
+        def decorator(handler):
+            self.routes.append((method, path, handler))
+            if require_token:
+                self._token_required.add(handler)
+            return handler
+        return decorator
+
+    def _authorized(self, request, handler):
+        if not self.token:
+            return handler not in self._token_required
+        supplied = request.headers.get("Authorization", "")
+        return secrets.compare_digest(supplied.encode(), f"Bearer {self.token}".encode())
+
+    async def _dispatch(self, request, handler):
+        if not self._authorized(request, handler):
+            status, error = (401, "unauthorized") if self.token else (403, "control_api_token_not_configured")
+            return json_response({"error": error}, status=status)
+        if self.in_flight >= self.max_concurrency:
+            self.rejected_total += 1
+            return json_response({"error": "too_many_requests"}, status=503)
+        self.in_flight += 1
+        try:
+            return await handler(request)
+        except ControlAPIError as e:
+            return json_response({"error": e.error}, status=e.status)
+        finally:
+            self.in_flight -= 1
+
+    async def start(self):
+        from aiohttp import web
+
+        @web.middleware
+        async def middleware(request, handler):
+            return await self._dispatch(request, handler)
+
+        app = web.Application(middlewares=[middleware], client_max_size=64 * 1024)
+        for method, path, handler in self.routes:
+            app.router.add_route(method, path, handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"✅ Control API 已啟動：http://{self.host}:{self.port}")
+        if not self.token and self.host not in ("127.0.0.1", "localhost", "::1"):
+            print("⚠️ 未設定 CONTROL_API_TOKEN，Control API 對外開放且不需驗證；匯出端點已停用")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+control_api = ControlAPI()
+
+@control_api.route("POST", "/move_user")
+async def move_user(request):
+    data = await read_json_body(request)
+    guild_id = require_int(data, "guild_id") if data.get("guild_id") is not None else None
+    result = await move_member(require_int(data, "discord_id"), require_int(data, "vc_id"), guild_id)
+    return json_response(result)
+
+@control_api.route("POST", "/move_users")
+async def move_users(request):
+    data = await read_json_body(request)
+    items = data.get("moves")
+    if not isinstance(items, list) or not items:
+        raise ControlAPIError(400, "missing_moves")
+    if len(items) > MOVE_BATCH_MAX:
+        raise ControlAPIError(413, "too_many_moves")
+    moves = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ControlAPIError(400, "invalid_moves")
+        guild_id = require_int(item, "guild_id") if item.get("guild_id") is not None else None
+        moves.append((require_int(item, "discord_id"), require_int(item, "vc_id"), guild_id))
+
+    results = await move_members(moves)
+    moved = sum(1 for r in results if r["status"] == "moved")
+    return json_response({"moved": moved, "failed": len(results) - moved, "results": results})
+
+metrics.gauge("peiplay_active_sessions", "進行中的配對場次", lambda: len(sessions))
+metrics.gauge("peiplay_scheduled_sessions", "尚未開始的排程",
+              lambda: sum(1 for job in journal.jobs.values() if job["phase"] == "scheduled"))
+metrics.gauge("peiplay_pending_ratings", "尚未回報的評價", lambda: sessions.rating_count)
+metrics.gauge("peiplay_member_index_size", "成員索引中的成員數", lambda: len(member_index))
+metrics.gauge("peiplay_user_cache_size", "使用者快取大小", lambda: len(user_resolver))
+metrics.gauge("peiplay_outbox_depth", "Outbox 待同步筆數", lambda: outbox.size)
+metrics.gauge("peiplay_channel_pool_idle", "預建頻道池閒置的語音頻道數", lambda: sum(pool.stats()["idle_voice"] for pool in channel_pools.values()))
+metrics.gauge("peiplay_control_api_in_flight", "Control API 處理中的請求", lambda: control_api.in_flight)
+metrics.gauge("peiplay_message_queue_depth", "等待發送的訊息數", lambda: message_queue.pending)
+metrics.gauge("peiplay_matchmaking_players", "配對佇列中的玩家數", lambda: matchmaker.depth[Matchmaker.PLAYER])
+metrics.gauge("peiplay_matchmaking_partners", "配對佇列中的陪玩數", lambda: matchmaker.depth[Matchmaker.PARTNER])
+metrics.gauge("peiplay_startup_seconds", "從載入模組到第一次 on_ready 完成的時間", lambda: startup.ready_seconds or 0)
+
+@control_api.route("GET", "/metrics")
+async def metrics_endpoint(request):
+    from aiohttp import web
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+@control_api.route("GET", "/export/pairings", require_token=True)
+async def export_pairings_endpoint(request):
+    """串流匯出配對紀錄：?start=YYYY-MM-DD&end=YYYY-MM-DD[&user_id=...][&format=csv|xlsx]"""
+    from aiohttp import web
+    query = request.query
+    fmt = query.get("format", "csv")
+    if fmt not in ("csv", "xlsx"):
+        raise ControlAPIError(400, "invalid_format")
+    try:
+        start_iso, end_iso = PairingExport.parse_range(query.get("start"), query.get("end"))
+    except ValueError:
+        raise ControlAPIError(400, "invalid_date_range")
+    user_id = query.get("user_id") or None
+    if user_id is not None and not user_id.isdigit():
+        raise ControlAPIError(400, "invalid_user_id")
+
+    if fmt == "xlsx":
+        try:
+            path = await asyncio.to_thread(pairing_export.write_file, fmt, start_iso, end_iso, user_id)
+        except ImportError:
+            raise ControlAPIError(501, "xlsx_unavailable")
+        chunks = None
+    else:
+        chunks = pairing_export.stream_csv(start_iso, end_iso, user_id)
+
+    filename = PairingExport.filename(fmt, query["start"], query["end"])
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/csv; charset=utf-8" if fmt == "csv"
+        else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+    response.enable_chunked_encoding()
+    try:
+        await response.prepare(request)
+        if chunks is not None:
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    await response.write(chunk)
+        else:
+            with open(path, "rb") as f:
+                while chunk := await asyncio.to_thread(f.read, 64 * 1024):
+                    await response.write(chunk)
+        await response.write_eof()
+    except ConnectionResetError:
+        pass    # 用戶端中途斷線
+    finally:
+        if chunks is None:
+            os.unlink(path)
+    return response
 
-@app.route("/discord_stats", methods=["GET"])
-def discord_stats():
+@control_api.route("GET", "/discord_stats")
+async def discord_stats(request):
     """提供 Discord Bot 統計資料的 API"""
     stats = {
-        "active_channels": len(active_voice_channels),
-        "total_ratings": len(pending_ratings),
-        "evaluated_records": len(evaluated_records)
+        "active_channels": len(sessions),
+        "total_ratings": pairing_history.rating_total(),
+        "pending_ratings": sessions.rating_count,
+        "evaluated_records": sessions.evaluated_count,
+        "outbox": outbox.stats(),
+        "message_queue": message_queue.stats(),
+        "matchmaking": matchmaker.stats(),
+        "channel_pool": {str(guild_id): pool.stats() for guild_id, pool in channel_pools.items()},
+        "process_id": PROCESS_ID,
+        "guilds": [str(g.id) for g in bot.guilds],
     }
-    return jsonify(stats)
+    return json_response(stats)
 
-def run_flask():
-    app.run(host="0.0.0.0", port=5000)
+startup.mark("載入模組")
 
-threading.Thread(target=run_flask, daemon=True).start()
-bot.run(TOKEN) 
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(TOKEN)
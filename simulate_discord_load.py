@@ -0,0 +1,644 @@
+"""Discord Bot 離線壓力模擬
+
+以行程內的假伺服器 / 假 REST 層取代 Discord，讓真正的 /createvc、延長按鈕、
+評分 Modal 與 Control API 移動 handler 同時跑上千個場次，並回報吞吐量、
+事件迴圈延遲百分位、每個場次的記憶體與計時器誤差。
+--queue-users 另外讓一批成員透過 /queue 自動配對，與 /createvc 交錯送出。
+
+假 REST 層可設定延遲與 429 比例；429 的處理方式比照 discord.py 的 HTTPClient
+（依 retry_after 等待後重試，超過次數才丟出 HTTPException）。
+為了在幾秒內跑完整個場次流程，場次長度、評分時間與延長秒數都會等比縮短。
+
+用法：
+    python simulate_discord_load.py --sessions 2000 --latency 0.08 --rate-limit 0.02
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import aiohttp
+import discord
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PeiPlay Discord Bot 離線壓力模擬")
+    parser.add_argument("--sessions", type=int, default=2000, help="場次數量")
+    parser.add_argument("--ramp", type=float, default=5.0, help="在幾秒內送出全部 /createvc")
+    parser.add_argument("--lead", type=float, default=1.0, help="排程後幾秒開始場次")
+    parser.add_argument("--session-seconds", type=float, default=6.0, help="語音階段長度（秒）")
+    parser.add_argument("--rating-window", type=float, default=2.0, help="評分階段長度（秒）")
+    parser.add_argument("--extend-seconds", type=float, default=2.0, help="每次延長的秒數")
+    parser.add_argument("--warning-seconds", type=float, default=1.0, help="結束前幾秒發出提醒")
+    parser.add_argument("--members", type=int, default=10000, help="伺服器內額外的成員數")
+    parser.add_argument("--latency", type=float, default=0.08, help="假 REST 平均延遲（秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="延遲浮動比例（0.5 = ±50%%）")
+    parser.add_argument("--rate-limit", type=float, default=0.02, help="每個請求回應 429 的機率")
+    parser.add_argument("--retry-after", type=float, default=0.5, help="429 的 retry_after（秒）")
+    parser.add_argument("--extend-prob", type=float, default=0.3, help="場次按下延長的機率")
+    parser.add_argument("--rating-prob", type=float, default=0.8, help="場次送出評分的機率")
+    parser.add_argument("--api-move-prob", type=float, default=0.2, help="場次透過 Control API 移動成員的機率")
+    parser.add_argument("--leave-prob", type=float, default=0.1, help="場次中途所有人離開語音的機率")
+    parser.add_argument("--queue-users", type=int, default=0, help="另外透過 /queue 自動配對的人數")
+    parser.add_argument("--queue-timeout", type=float, default=5.0, help="MATCH_QUEUE_TIMEOUT（秒）")
+    parser.add_argument("--empty-grace", type=float, default=1.0, help="EMPTY_SESSION_GRACE_SECONDS")
+    parser.add_argument("--move-rate", type=float, default=200, help="DISCORD_MOVE_RATE（每秒移動數）")
+    parser.add_argument("--move-burst", type=int, default=200, help="DISCORD_MOVE_BURST")
+    parser.add_argument("--global-rate", type=float, default=1000, help="DISCORD_GLOBAL_RATE")
+    parser.add_argument("--pool-size", type=int, default=0, help="CHANNEL_POOL_SIZE")
+    parser.add_argument("--timeout", type=float, default=600, help="最長執行秒數")
+    parser.add_argument("--seed", type=int, default=None, help="亂數種子")
+    parser.add_argument("--no-memory", action="store_true", help="不啟用 tracemalloc（吞吐量較準）")
+    return parser.parse_args(argv)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+SIM_GUILD_ID = 900000000000000001
+SIM_ADMIN_CHANNEL_ID = 900000000000000002
+
+def configure_env(args, workdir):
+    """bot 模組在 import 時讀取設定，必須先設好環境變數"""
+    os.environ.update({
+        "DISCORD_GUILD_ID": str(SIM_GUILD_ID),
+        "ADMIN_CHANNEL_ID": str(SIM_ADMIN_CHANNEL_ID),
+        "BOT_DB_PATH": os.path.join(workdir, "sim_bot.db"),
+        "JOURNAL_PATH": os.path.join(workdir, "sim_journal.jsonl"),
+        "CONTROL_API_HOST": "127.0.0.1",
+        "CONTROL_API_PORT": str(free_port()),
+        "OUTBOX_MAX_SIZE": str(max(10000, args.sessions * 4)),
+        "DISCORD_MOVE_RATE": str(args.move_rate),
+        "DISCORD_MOVE_BURST": str(args.move_burst),
+        "DISCORD_GLOBAL_RATE": str(args.global_rate),
+        "CHANNEL_POOL_SIZE": str(args.pool_size),
+        "ADMIN_DIGEST_INTERVAL": "0",
+        "EMPTY_SESSION_GRACE_SECONDS": str(args.empty_grace),
+        "MATCH_QUEUE_TIMEOUT": str(args.queue_timeout),
+    })
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def histogram_quantile(histogram, q, *labels):
+    """從固定 bucket 的直方圖估計百分位（回傳 bucket 上界）"""
+    series = histogram.series.get(labels)
+    if not series or not series[-1]:
+        return None
+    target = q * series[-1]
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, series):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return float("inf")
+
+# --- 假 REST 層 ---
+class FakeResponse:
+    def __init__(self, status: int, retry_after: float):
+        self.status = status
+        self.reason = "Too Many Requests"
+        self.headers = {"Retry-After": str(retry_after)}
+
+class FakeREST:
+    """模擬 Discord REST：隨機延遲、機率性 429，並記錄每個 route 的耗時"""
+
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, latency: float, jitter: float, rate_limit: float, retry_after: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.calls = {}         # route -> [耗時...]
+        self.rate_limited = 0
+        self._log = logging.getLogger("discord.http")
+
+    async def call(self, route: str):
+        started = time.perf_counter()
+        try:
+            for _ in range(self.MAX_ATTEMPTS):
+                await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+                if random.random() >= self.rate_limit:
+                    return
+                self.rate_limited += 1
+                # 與 discord.py 相同的訊息，讓 bot 的 429 計數也能運作
+                self._log.warning("We are being rate limited. %s responded with 429. Retrying in %.2f seconds.",
+                                  route, self.retry_after)
+                await asyncio.sleep(self.retry_after)
+            raise discord.HTTPException(FakeResponse(429, self.retry_after), {"message": "You are being rate limited.", "code": 0})
+        finally:
+            self.calls.setdefault(route, []).append(time.perf_counter() - started)
+
+# --- 假伺服器 ---
+class FakeRole:
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+class FakeMember:
+    def __init__(self, guild, id: int, name: str):
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.global_name = name.replace("_", " ").title()
+        self.display_name = self.global_name
+        self.mention = f"<@{id}>"
+        self.voice = None
+        self.guild_permissions = discord.Permissions.none()
+
+    async def move_to(self, channel):
+        await self.guild.rest.call(f"PATCH /guilds/{self.guild.id}/members")
+        self.set_voice(channel)
+
+    def set_voice(self, channel):
+        """更新語音狀態並送出 VOICE_STATE_UPDATE"""
+        before = self.voice.channel if self.voice else None
+        if before:
+            before._members.discard(self)
+        self.voice = FakeVoiceState(channel) if channel else None
+        if channel:
+            channel._members.add(self)
+        sim = self.guild.sim
+        sim.spawn(sim.engine.on_voice_state_update(self, FakeVoiceState(before), FakeVoiceState(channel)))
+
+class FakeCategory:
+    def __init__(self, id: int, name: str):
+        self.id = id
+        self.name = name
+        self.channels = []
+
+def make_channel_classes(sim):
+    """建立繼承 discord.py 頻道型別的假頻道（Control API 會檢查 isinstance）"""
+    class FakeChannelMixin:
+        def _init_fake(self, guild, id, name, overwrites):
+            self.guild = guild
+            self.id = id
+            self.name = name
+            self._overwrites = dict(overwrites or {})
+            self._members = set()
+
+        @property
+        def overwrites(self):
+            return self._overwrites
+
+        @property
+        def members(self):
+            return list(self._members)
+
+        @property
+        def mention(self):
+            return f"<#{self.id}>"
+
+        async def edit(self, *, name=None, overwrites=None, user_limit=None, **kwargs):
+            await self.guild.rest.call("PATCH /channels/{channel_id}")
+            if name is not None:
+                self.name = name
+            if overwrites is not None:
+                self._overwrites = dict(overwrites)
+
+        async def delete(self, **kwargs):
+            await self.guild.rest.call("DELETE /channels/{channel_id}")
+            self.guild._channels.pop(self.id, None)
+            sim.channels_deleted += 1
+
+        async def purge(self, **kwargs):
+            await self.guild.rest.call("POST /channels/{channel_id}/messages/bulk-delete")
+            return []
+
+        async def send(self, content=None, *, view=None, **kwargs):
+            await self.guild.rest.call("POST /channels/{channel_id}/messages")
+            sim.on_message(self, content, view)
+            return FakeMessage(next(self.guild.ids), self)
+
+    class FakeVoiceChannel(FakeChannelMixin, discord.VoiceChannel):
+        def __init__(self, guild, id, name, overwrites=None, category=None):
+            self._init_fake(guild, id, name, overwrites)
+
+        def __repr__(self):
+            return f"<FakeVoiceChannel id={self.id} name={self.name!r}>"
+
+    class FakeTextChannel(FakeChannelMixin, discord.TextChannel):
+        def __init__(self, guild, id, name, overwrites=None, category=None):
+            self._init_fake(guild, id, name, overwrites)
+
+        def __repr__(self):
+            return f"<FakeTextChannel id={self.id} name={self.name!r}>"
+
+    return FakeVoiceChannel, FakeTextChannel
+
+class FakeMessage:
+    def __init__(self, id: int, channel):
+        self.id = id
+        self.channel = channel
+
+class FakeGuild:
+    def __init__(self, sim, rest: FakeREST, id: int, category_name: str):
+        self.sim = sim
+        self.rest = rest
+        self.id = id
+        self.name = "PeiPlay 模擬伺服器"
+        self.ids = itertools.count(id + 1000)
+        self.default_role = FakeRole(id, "@everyone")
+        self.me = FakeRole(next(self.ids), "PeiPlay Bot")
+        self.categories = [FakeCategory(next(self.ids), category_name)]
+        self._members = {}
+        self._channels = {}
+        self.lobby = self._add_channel(sim.voice_cls, "大廳", None, None)
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def add_member(self, name: str):
+        member = FakeMember(self, next(self.ids), name)
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def _add_channel(self, cls, name, overwrites, category, channel_id=None):
+        channel = cls(self, channel_id or next(self.ids), name, overwrites)
+        self._channels[channel.id] = channel
+        if category is not None:
+            category.channels.append(channel)
+        return channel
+
+    async def create_voice_channel(self, name, *, overwrites=None, category=None, **kwargs):
+        await self.rest.call(f"POST /guilds/{self.id}/channels")
+        self.sim.channels_created += 1
+        return self._add_channel(self.sim.voice_cls, name, overwrites, category)
+
+    async def create_text_channel(self, name, *, overwrites=None, category=None, **kwargs):
+        await self.rest.call(f"POST /guilds/{self.id}/channels")
+        self.sim.channels_created += 1
+        return self._add_channel(self.sim.text_cls, name, overwrites, category)
+
+# --- 假互動 ---
+class FakeInteractionResponse:
+    def __init__(self, interaction):
+        self._interaction = interaction
+        self._done = False
+        self.modal = None
+
+    def is_done(self):
+        return self._done
+
+    async def _callback(self):
+        await self._interaction.guild.rest.call("POST /interactions/{interaction_id}/{token}/callback")
+        self._done = True
+
+    async def defer(self, **kwargs):
+        await self._callback()
+
+    async def send_message(self, content=None, **kwargs):
+        await self._callback()
+        self._interaction.messages.append(content)
+
+    async def send_modal(self, modal):
+        await self._callback()
+        self.modal = modal
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await self._interaction.guild.rest.call("POST /webhooks/{application_id}/{token}")
+        self._interaction.messages.append(content)
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user: FakeMember):
+        self.guild = guild
+        self.user = user
+        self.messages = []
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+
+# --- 模擬流程 ---
+class Simulation:
+    def __init__(self, args, engine):
+        self.args = args
+        self.engine = engine
+        self.voice_cls, self.text_cls = make_channel_classes(self)
+        self.rest = FakeREST(args.latency, args.jitter, args.rate_limit, args.retry_after)
+        self.guild = FakeGuild(self, self.rest, SIM_GUILD_ID, engine.SESSION_CATEGORY_NAME)
+        self.admin_channel = self.guild._add_channel(self.text_cls, "管理區", None, None, SIM_ADMIN_CHANNEL_ID)
+        self.pairs = []
+        self.queue_users = []
+        self.tasks = set()
+        self.createvc_latency = []
+        self.api_move_latency = []
+        self.api_moves = 0
+        self.api_move_errors = {}   # 原因 -> 次數
+        self.loop_lag = []
+        self.memory_samples = []    # (已追蹤記憶體, 進行中場次)
+        self.channels_created = 0
+        self.channels_deleted = 0
+        self.opened = 0
+        self.extended = 0
+        self.ratings_submitted = 0
+        self.ratings_accepted = 0
+        self.admin_messages = 0
+        self.admin_reports = 0
+        self.abandoned = 0
+        self.errors = []
+
+    def populate(self):
+        for i in range(self.args.sessions):
+            owner = self.guild.add_member(f"sim_owner_{i}")
+            partner = self.guild.add_member(f"sim_partner_{i}")
+            for member in (owner, partner):
+                member.voice = FakeVoiceState(self.guild.lobby)
+                self.guild.lobby._members.add(member)
+            self.pairs.append((owner, partner))
+        for i in range(self.args.queue_users):
+            member = self.guild.add_member(f"sim_queue_{i}")
+            member.voice = FakeVoiceState(self.guild.lobby)
+            self.guild.lobby._members.add(member)
+            self.queue_users.append(member)
+        for i in range(self.args.members):
+            self.guild.add_member(f"sim_member_{i}")
+
+    def spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            self.errors.append(repr(task.exception()))
+
+    def patch_bot(self):
+        """讓 bot 透過假的 gateway 快取取得伺服器、頻道與使用者"""
+        bot = self.engine.bot
+        bot.get_guild = lambda guild_id: self.guild if guild_id == self.guild.id else None
+        bot.get_channel = lambda channel_id: self.guild.get_channel(channel_id)
+        bot.get_user = lambda user_id: self.guild.get_member(user_id)
+
+        async def fetch_user(user_id):
+            await self.rest.call("GET /users/{user_id}")
+            return self.guild.get_member(user_id)
+        bot.fetch_user = fetch_user
+
+        # 等比縮短場次時間：語音長度、延長、提醒與評分階段
+        self.engine.WARNING_SECONDS = self.args.warning_seconds
+        self.engine.EXTEND_SECONDS = self.args.extend_seconds
+        self.engine.RATING_WINDOW_SECONDS = self.args.rating_window
+        schedule_start = self.engine.schedule_start
+
+        def compressed_schedule_start(job):
+            job["start_ts"] = time.time() + self.args.lead
+            job["minutes"] = self.args.session_seconds / 60
+            schedule_start(job)
+        self.engine.schedule_start = compressed_schedule_start
+
+    def on_message(self, channel, content, view):
+        if channel is self.admin_channel:
+            self.admin_messages += 1
+            self.admin_reports += content.count("📋 配對紀錄")
+            self.abandoned += content.count("提前結束")
+        elif isinstance(view, self.engine.ExtendView):
+            self.opened += 1
+            self.spawn(self.after_open(channel, view))
+        elif view is not None and view.children:
+            self.spawn(self.rate(channel, view))
+
+    def participants(self, channel):
+        session = self.engine.sessions.get_by_text(channel.id)
+        if session is None:
+            return None, []
+        return session, [self.guild.get_member(int(i)) for i in session.participant_ids]
+
+    async def after_open(self, channel, view):
+        session, members = self.participants(channel)
+        if session is None:
+            return
+        if random.random() < self.args.api_move_prob:
+            await self.api_move(members, session.vc_id)
+        if random.random() < self.args.extend_prob:
+            await asyncio.sleep(random.uniform(0, self.args.session_seconds / 2))
+            interaction = FakeInteraction(self.guild, members[0])
+            await view.extend_button.callback(interaction)
+            self.extended += 1
+        if random.random() < self.args.leave_prob:
+            await asyncio.sleep(random.uniform(0, self.args.session_seconds / 2))
+            for member in members:
+                member.set_voice(None)
+
+    async def api_move(self, members, vc_id):
+        payload = {"moves": [{"discord_id": m.id, "vc_id": vc_id} for m in members]}
+        url = f"http://127.0.0.1:{self.engine.CONTROL_API_PORT}/move_users"
+        started = time.perf_counter()
+        async with self.http.post(url, json=payload) as response:
+            data = await response.json()
+        self.api_move_latency.append(time.perf_counter() - started)
+        if response.status != 200:
+            reason = f"HTTP {response.status} {data.get('error')}"
+            self.api_move_errors[reason] = self.api_move_errors.get(reason, 0) + len(members)
+            return
+        for result in data["results"]:
+            if result["status"] == "moved":
+                self.api_moves += 1
+            else:
+                self.api_move_errors[result["error"]] = self.api_move_errors.get(result["error"], 0) + 1
+
+    async def rate(self, channel, view):
+        session, members = self.participants(channel)
+        if session is None or random.random() >= self.args.rating_prob:
+            return
+        await asyncio.sleep(random.uniform(0, self.args.rating_window / 2))
+        interaction = FakeInteraction(self.guild, random.choice(members))
+        await view.children[0].callback(interaction)
+        modal = interaction.response.modal
+        if modal is None:
+            return
+        modal.rating._value = str(random.randint(1, 5))
+        modal.comment._value = random.choice(["", "很好玩", "下次再約"])
+        submit = FakeInteraction(self.guild, interaction.user)
+        await modal.on_submit(submit)
+        self.ratings_submitted += 1
+        if submit.messages and submit.messages[-1].startswith("✅"):
+            self.ratings_accepted += 1
+
+    async def createvc(self, owner, partner):
+        start_time = (datetime.now(self.engine.TW_TZ) + timedelta(minutes=2)).strftime("%H:%M")
+        interaction = FakeInteraction(self.guild, owner)
+        started = time.perf_counter()
+        await self.engine.createvc.callback(interaction, members=partner.name, minutes=1, start_time=start_time)
+        self.createvc_latency.append(time.perf_counter() - started)
+        if not interaction.messages or not interaction.messages[-1].startswith("✅"):
+            self.errors.append(f"/createvc 失敗：{interaction.messages[-1:]}")
+
+    async def queue(self, member):
+        engine = self.engine
+        role = random.choice([engine.Matchmaker.PLAYER, engine.Matchmaker.PARTNER])
+        minutes = random.choice(engine.MATCH_MINUTES)
+        interaction = FakeInteraction(self.guild, member)
+        await engine.queue.callback(interaction, role=discord.app_commands.Choice(name=role, value=role),
+                                    minutes=discord.app_commands.Choice(name=f"{minutes} 分鐘", value=minutes))
+        if not interaction.messages or interaction.messages[-1][0] not in "🕒✅":
+            self.errors.append(f"/queue 失敗：{interaction.messages[-1:]}")
+
+    async def sample(self, interval: float = 0.01):
+        """量測事件迴圈延遲，並定期記錄記憶體用量"""
+        last_memory = 0.0
+        while True:
+            expected = time.perf_counter() + interval
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            self.loop_lag.append(max(0.0, now - expected))
+            if tracemalloc.is_tracing() and now - last_memory >= 0.25:
+                last_memory = now
+                self.memory_samples.append((tracemalloc.get_traced_memory()[0], len(self.engine.sessions)))
+
+    def finished(self):
+        engine = self.engine
+        return (not self.tasks and not engine.journal.jobs and not len(engine.sessions)
+                and not engine.message_queue.pending and not len(engine.matchmaker))
+
+    async def run(self):
+        engine = self.engine
+        self.patch_bot()
+        self.populate()
+        await engine.member_index.build(self.guild)
+        engine.loop_watchdog.start()
+        engine.journal.load()
+        engine.admin_reporter.start()
+        engine.channel_pool_for(self.guild.id).start(self.guild)
+        await engine.control_api.start()
+        baseline = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        sampler = asyncio.get_running_loop().create_task(self.sample())
+        self.http = aiohttp.ClientSession()
+
+        started = time.perf_counter()
+        try:
+            actions = [(self.createvc, pair) for pair in self.pairs] + [(self.queue, (m,)) for m in self.queue_users]
+            random.shuffle(actions)
+            for i, (action, action_args) in enumerate(actions):
+                self.spawn(action(*action_args))
+                delay = started + self.args.ramp * (i + 1) / len(actions) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            while not self.finished():
+                if time.perf_counter() - started > self.args.timeout:
+                    self.errors.append(f"逾時：仍有 {len(engine.journal.jobs)} 筆排程未結束")
+                    break
+                await asyncio.sleep(0.1)
+            elapsed = time.perf_counter() - started
+        finally:
+            sampler.cancel()
+            await self.http.close()
+            engine.loop_watchdog.stop()
+            engine.channel_pool_for(self.guild.id).stop()
+            await engine.control_api.stop()
+            await engine.admin_reporter.stop()
+            engine.journal.close()
+            for task in list(self.tasks):
+                task.cancel()
+        return elapsed, baseline
+
+    def report(self, elapsed: float, baseline: int):
+        engine, args = self.engine, self.args
+        ms = lambda seconds: f"{seconds * 1000:.1f}ms"
+
+        print("\n=== 模擬結果 ===")
+        print(f"場次：{args.sessions}（開場 {self.opened}，延長 {self.extended}，"
+              f"評分 {self.ratings_accepted}/{self.ratings_submitted}，管理區回報 {self.admin_reports}（{self.admin_messages} 則訊息），"
+              f"無人提前結束 {self.abandoned}）")
+        print(f"總耗時：{elapsed:.1f}s，吞吐量：{args.sessions / elapsed:.1f} 場次/s，"
+              f"/createvc {len(self.createvc_latency) / max(args.ramp, 1e-9):.1f} 次/s")
+        for name, values in (("/createvc", self.createvc_latency), ("Control API /move_users", self.api_move_latency)):
+            if values:
+                print(f"{name} 延遲：p50 {ms(percentile(values, 0.5))}  p95 {ms(percentile(values, 0.95))}  "
+                      f"p99 {ms(percentile(values, 0.99))}  max {ms(max(values))}")
+        if args.queue_users:
+            results = engine.matchmaking_results.values
+            line = (f"/queue：{args.queue_users} 人，配對 {results.get(('matched',), 0)} 組，"
+                    f"逾時 {results.get(('expired',), 0)} 人")
+            for role in (engine.Matchmaker.PLAYER, engine.Matchmaker.PARTNER):
+                p99 = histogram_quantile(engine.matchmaking_wait, 0.99, role)
+                if p99 is not None:
+                    line += f"，{role} 等待 p99 ≤ {p99}s"
+            p99 = histogram_quantile(engine.matchmaking_latency, 0.99)
+            if p99 is not None:
+                line += f"，配對計算 p99 ≤ {ms(p99)}"
+            print(line)
+        if self.api_move_latency:
+            print(f"Control API 移動：成功 {self.api_moves}，失敗 {sum(self.api_move_errors.values())} {self.api_move_errors or ''}")
+        print(f"事件迴圈延遲：p50 {ms(percentile(self.loop_lag, 0.5))}  p95 {ms(percentile(self.loop_lag, 0.95))}  "
+              f"p99 {ms(percentile(self.loop_lag, 0.99))}  max {ms(max(self.loop_lag, default=0))}"
+              f"，卡頓 {len(engine.loop_watchdog.stalls)} 次")
+
+        peak = max(self.memory_samples, key=lambda sample: sample[1], default=None)
+        if peak and peak[1]:
+            print(f"記憶體：同時 {peak[1]} 場次時 {(peak[0] - baseline) / 1024 / 1024:.1f} MiB，"
+                  f"約 {(peak[0] - baseline) / peak[1] / 1024:.1f} KiB / 場次")
+
+        for kind in ("start", "warning", "end"):
+            count = engine.countdown_drift.series.get((kind,), [0])[-1]
+            if count:
+                p50 = histogram_quantile(engine.countdown_drift, 0.5, kind)
+                p99 = histogram_quantile(engine.countdown_drift, 0.99, kind)
+                print(f"計時器誤差（{kind}）：{count} 次，p50 ≤ {ms(p50)}  p99 ≤ {ms(p99)}")
+        lag = engine.session_start_lag
+        if lag.series.get(()):
+            print(f"開場延遲：p50 ≤ {ms(histogram_quantile(lag, 0.5))}  p99 ≤ {ms(histogram_quantile(lag, 0.99))}")
+
+        calls = sum(len(v) for v in self.rest.calls.values())
+        print(f"REST：{calls} 次請求，429 {self.rest.rate_limited} 次，"
+              f"建立頻道 {self.channels_created}、刪除 {self.channels_deleted}")
+        for route, values in sorted(self.rest.calls.items(), key=lambda item: -len(item[1])):
+            print(f"  {route:<48} {len(values):>7}  p50 {ms(percentile(values, 0.5))}  p99 {ms(percentile(values, 0.99))}")
+        for name, stats in engine.message_queue.stats()["channels"].items():
+            print(f"訊息發送延遲（{name}）：p50 {ms(stats['p50'])}  p95 {ms(stats['p95'])}  p99 {ms(stats['p99'])}")
+        pool = engine.channel_pool_for(self.guild.id)
+        if pool.enabled:
+            print(f"頻道池：{pool.stats()}")
+
+        if self.errors:
+            print(f"\n❌ {len(self.errors)} 個錯誤，前 5 個：")
+            for error in self.errors[:5]:
+                print(f"  {error}")
+        return not self.errors
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="peiplay_sim_") as workdir:
+        configure_env(args, workdir)
+        import peiplay_discord_bot as engine
+
+        if not args.no_memory:
+            tracemalloc.start()
+        simulation = Simulation(args, engine)
+        elapsed, baseline = asyncio.run(simulation.run())
+        ok = simulation.report(elapsed, baseline)
+        engine.local_db.close()
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import asyncio
+import csv
+import io
+import os
+import tempfile
+
+import pytest
+
+# bot 模組在 import 時讀取設定並開啟本地檔案，先指到暫存目錄
+_workdir = tempfile.mkdtemp(prefix="peiplay_test_")
+os.environ.update({
+    "BOT_DB_PATH": os.path.join(_workdir, "bot.db"),
+    "JOURNAL_PATH": os.path.join(_workdir, "journal.jsonl"),
+    "STATE_DB_PATH": os.path.join(_workdir, "state.db"),
+    "CONTROL_API_PORT": "0",
+})
+
+import peiplay_discord_bot as bot_module
+
+
+def test_histogram_overflow_does_not_touch_sum():
+    histogram = bot_module.Histogram("x", "測試", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(5.0)
+
+    lines = list(histogram.render())
+    assert 'x_bucket{le="0.1"} 1' in lines
+    assert 'x_bucket{le="1"} 1' in lines
+    assert 'x_bucket{le="+Inf"} 2' in lines
+    assert "x_sum 5.05" in lines
+    assert "x_count 2" in lines
+
+
+class _FakeGuild:
+    def __init__(self, guild_id=1):
+        self.id = guild_id
+        self.name = "測試伺服器"
+        self.members = []
+
+    def get_member(self, member_id):
+        return next((m for m in self.members if m.id == member_id), None)
+
+
+class _FakeMember:
+    def __init__(self, guild, member_id, name, display_name):
+        self.guild = guild
+        self.id = member_id
+        self.name = name
+        self.global_name = display_name
+        self.display_name = display_name
+
+
+def test_member_index_refuses_ambiguous_names_and_suggests_from_bigrams():
+    guild = _FakeGuild()
+    guild.members = [
+        _FakeMember(guild, 1, "alice", "小明"),
+        _FakeMember(guild, 2, "bob", "小明"),
+        _FakeMember(guild, 3, "carol", "小華"),
+    ]
+    index = bot_module.MemberIndex()
+    asyncio.run(index.build(guild))
+
+    assert index.lookup(guild, "小明") is None
+    assert sorted(index.suggest(guild, "小明")) == ["alice", "bob"]
+    assert index.lookup(guild, "CAROL").id == 3
+    assert index.suggest(guild, "carl") == ["carol"]
+
+    index.remove(guild.members[2])
+    assert index.suggest(guild, "carl") == []
+
+
+def test_scheduled_callbacks_start_their_own_trace():
+    tracer = bot_module.Tracer(enabled=True)
+    scheduler = bot_module.DeadlineScheduler()
+
+    async def start_session():
+        with tracer.span("session.start"):
+            await asyncio.sleep(0)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        with tracer.span("/createvc"):
+            with tracer.span("schedule"):
+                scheduler.schedule(1, "start", loop.time() + 0.01, start_session)
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+
+    assert [span.name for span in tracer.recent] == ["/createvc", "session.start"]
+    assert tracer.recent[0].children[0].children == []
+
+
+def test_rate_limit_scheduler_drops_idle_route_buckets():
+    scheduler = bot_module.RateLimitScheduler(bot_module.TokenBucket(1e6, 1e6))
+
+    async def send():
+        return "ok"
+
+    async def main():
+        for channel_id in range(300):
+            assert await scheduler.run(f"POST /channels/{channel_id}/messages", send, 1000, 1) == "ok"
+            await asyncio.sleep(0.002)
+
+    asyncio.run(main())
+
+    assert len(scheduler) <= bot_module.RateLimitScheduler.SWEEP_MIN
+    assert scheduler._active == {}
+
+
+def _export_record_with_comment(comment):
+    record = bot_module.DiscordPairingRecord("111", "222", 30, "測試")
+    bot_module.pairing_history.save_record(record)
+    bot_module.pairing_history.add_rating(record.id, "111", "222", 5, comment)
+    today = record.created_at.strftime("%Y-%m-%d")
+    return record, bot_module.PairingExport.parse_range(today, today)
+
+
+def test_csv_export_neutralises_formula_comments():
+    record, (start_iso, end_iso) = _export_record_with_comment('=HYPERLINK("http://evil.example","x")')
+
+    data = b"".join(bot_module.pairing_export.csv_chunks(start_iso, end_iso, "111")).decode("utf-8-sig")
+    rows = [row for row in csv.DictReader(io.StringIO(data)) if row["record_id"] == record.id]
+
+    assert rows[0]["comment"] == '\'=HYPERLINK("http://evil.example","x")'
+    assert rows[0]["user1_id"] == "111"
+
+
+def test_xlsx_export_stores_formula_comments_as_text():
+    openpyxl = pytest.importorskip("openpyxl")
+    record, (start_iso, end_iso) = _export_record_with_comment("@SUM(1+1)")
+
+    path = bot_module.pairing_export.write_file("xlsx", start_iso, end_iso, "111")
+    try:
+        sheet = openpyxl.load_workbook(path).active
+        comments = [row[13] for row in sheet.iter_rows(min_row=2) if row[0].value == record.id]
+        assert comments[0].value == "@SUM(1+1)"
+        assert comments[0].data_type == "s"
+    finally:
+        os.unlink(path)